@@ -1,6 +1,7 @@
 
 from mydecorators import autoassign, cached_property, setdefaultattr, decorator
 import random
+import numpy as np
 from numpy.lib.scimath import sqrt
 from numpy.core.fromnumeric import mean, std
 from numpy.lib.function_base import median
@@ -112,26 +113,158 @@ class Tallies(list):
         return tally
 
 ##Election Methods
+resultsCacheTally = SideTally() #"hit"s and "miss"es of Method.chosenResults; CsvBatch resets it
+
 class Method:
     """Base class for election methods. Holds some of the duct tape."""
 
     def __str__(self):
         return self.__class__.__name__
 
-    def results(self, ballots, **kwargs):
+    def results(self, ballots, *, weights=None, **kwargs):
         """Combines ballots into results. Override for comparative
         methods.
 
         Ballots is an iterable of list-or-tuple of numbers (utility) higher is better for the choice of that index.
 
+        weights, if given, says how many voters cast each ballot, so a
+        compressed profile (see compressBallots) gives the same results as the
+        ballots it came from. Every override takes it, keyword-only (so it
+        can't be mistaken for isHonest), as does candScore.
+
         Returns a results-array which should be a list of the same length as a ballot with a number (higher is better) for the choice at that index.
 
         Test for subclasses, makes no sense to test this method in the abstract base class.
         """
+        if weights is not None:
+            return [self.candScore(scores, weights) for scores in np.asarray(ballots).T]
         if type(ballots) is not list:
             ballots = list(ballots)
         return list(map(self.candScore,zip(*ballots)))
 
+    #Keys that an honest run may record in extraEvents
+    extraEventKeys = ()
+
+    def tallySlots(self, chooserFuns=()):
+        """How many (tallyName, tallyVal) pairs a resultsTable row can need:
+        the honest row's extraEvents, the strategic row's media tally, the OSS
+        row's tallies plus "worked", or the chooserFuns' tallies.
+
+            >>> from stratFunctions import ProbChooser, beHon, beStrat, beX
+            >>> Method().tallySlots([ProbChooser([(.5, beHon), (.25, beStrat), (.25, beX)])])
+            3
+        """
+        from stratFunctions import OssChooser
+        return max([len(self.extraEventKeys), 1, OssChooser().tallyCount() + 1] +
+                   [chooser.tallyCount() for chooser in chooserFuns])
+
+    #Methods whose results depend on the ballots only through a sum over
+    #voters override tallyStat(ballots), returning that sum (or None, if it
+    #can't be had for those ballots), and statResults(stat, nvot). See deltaResults.
+    tallyStat = None
+
+    #Methods whose results break ties with random draws (see winner) set this,
+    #so that each chooser's results draw afresh rather than being reused.
+    randomResults = False
+
+    def statResults(self, stat, nvot):
+        """results, from the tallyStat of nvot ballots."""
+        raise NotImplementedError("{} needs statResults".format(self))
+
+    def ballotChanges(self, voters, kinds):
+        """(who, rows): the indices of the voters whose stored ballot of the
+        given kind (one kind per voter) differs from their honest one, and
+        those ballots. Together they pin down the whole ballot set cheaply.
+        """
+        cls = self.__class__
+        hon = voters.ballots[cls, "hon"]
+        moved = np.flatnonzero(kinds != "hon")
+        rows = voters.ballots.pick(cls, kinds[moved], moved) if len(moved) else hon[moved]
+        changed = np.any(rows != hon[moved], axis=1)
+        return moved[changed], rows[changed]
+
+    def deltaResults(self, voters, who, rows):
+        """results for voters casting their honest ballots, except that voters
+        who cast rows instead (see ballotChanges), found by patching the tally
+        of the honest ballots with (new - honest) for just those voters.
+
+        >>> from methods import Borda
+        >>> elec = ArrayElectorate([[0, 1, 2], [2, 1, 0], [1, 2, 0]])
+        >>> for v in elec:
+        ...     hon = Borda.honBallot(Borda, v)
+        ...     elec.ballots.put(Borda, "strat", v.rowIndex, [0, 0, 2])
+        >>> kinds = np.array(["hon", "strat", "strat"])
+        >>> who, rows = Borda().ballotChanges(elec, kinds)
+        >>> who.tolist()
+        [1, 2]
+        >>> Borda().deltaResults(elec, who, rows) == Borda().results(elec.ballots.pick(Borda, kinds))
+        True
+        """
+        cls = self.__class__
+        store = voters.ballots
+        hon = store[cls, "hon"]
+        if (cls, "honStat") not in store.built:
+            store.built[cls, "honStat"] = self.tallyStat(hon)
+        stat = store.built[cls, "honStat"]
+        if stat is not None and len(who):
+            newStat, oldStat = self.tallyStat(rows), self.tallyStat(hon[who])
+            stat = (None if newStat is None or oldStat is None
+                    else stat + newStat - oldStat)
+        if stat is not None:
+            return self.statResults(stat, len(hon))
+        ballots = hon.copy() #recount from scratch
+        ballots[who] = rows
+        return self.resultsOf(voters, ballots)
+
+    @staticmethod
+    def resultsKey(who, rows, kwargs):
+        """The key in an election's results cache for a ballot set given as
+        ballotChanges, tallied with results(..., **kwargs)."""
+        return (who.tobytes(), rows.tobytes(), tuple(sorted(kwargs.items())))
+
+    def resultsOf(self, voters, ballots, **kwargs):
+        """results(ballots, **kwargs) for an election among voters. Methods
+        that tally pairwise margins get the election's cache of them, so
+        tallies of the same ballots (eg by Schulze and Rp) share the work.
+        """
+        store = getattr(voters, "ballots", None)
+        if store is not None:
+            kwargs["marginCache"] = store.margins
+        return self.results(ballots, **kwargs)
+
+    def chosenResults(self, voters, kinds, **kwargs):
+        """results for voters casting their stored ballots of the given kinds.
+
+        Choosers often come up with a ballot set already tallied in this
+        election (all honest, or the same as OSS), so each method keeps the
+        results (and extraEvents) of every set it has tallied, keyed by its
+        ballotChanges, and looks repeats up; resultsCacheTally counts the
+        hits and misses. Methods with randomResults aren't cached.
+        """
+        cls = self.__class__
+        store = voters.ballots
+        if (cls, "hon") not in store or self.randomResults:
+            return self.resultsOf(voters, store.pick(cls, kinds), **kwargs)
+        who, rows = self.ballotChanges(voters, kinds)
+        cache = store.built.setdefault((cls, "results"), dict())
+        key = self.resultsKey(who, rows, kwargs)
+        try:
+            results, events = cache[key]
+        except KeyError:
+            resultsCacheTally["miss"] += 1
+        else:
+            resultsCacheTally["hit"] += 1
+            if events is not None:
+                cls.extraEvents = dict(events)
+            return list(results)
+        if self.tallyStat is not None and not kwargs:
+            results = self.deltaResults(voters, who, rows)
+        else:
+            results = self.resultsOf(voters, store.pick(cls, kinds), **kwargs)
+        events = getattr(cls, "extraEvents", None)
+        cache[key] = (list(results), None if events is None else dict(events))
+        return results
+
     @staticmethod #cls is provided explicitly, not through binding
     #@rememberBallot
     def honBallot(cls, utils):
@@ -172,9 +305,16 @@ class Method:
         if tally is None:
             tally = SideTally()
         tally.initKeys(chooser)
-        return dict(results=self.results([chooser(self.__class__, voter, tally)
-                                  for voter in voters],
-                              **kwargs),
+        if hasattr(chooser, "kinds") and hasattr(voters, "ballots"):
+            kinds = chooser.kinds(self.__class__, voters, tally)
+            results = self.chosenResults(voters, kinds, **kwargs)
+        elif hasattr(chooser, "allBallots") and hasattr(voters, "ballots"):
+            results = self.resultsOf(voters, chooser.allBallots(self.__class__, voters),
+                                     **kwargs)
+        else:
+            results = self.resultsOf(voters, [chooser(self.__class__, voter, tally)
+                                              for voter in voters], **kwargs)
+        return dict(results=results,
                 chooser=chooser.__name__,
                 tally=tally)
 
@@ -190,9 +330,17 @@ class Method:
         """
         from stratFunctions import OssChooser
 
+        voters = asElectorate(voters)
         honTally = SideTally()
         self.__class__.extraEvents = dict()
         hon = self.resultsFor(voters, self.honBallotFor(voters), honTally, isHonest=True)
+        if (self.__class__, "hon") in voters.ballots and not self.randomResults:
+            #isHonest only adds extraEvents, so these also stand for any
+            #chooser that ends up with everyone honest
+            noChange = np.zeros(0, dtype=int)
+            voters.ballots.built[self.__class__, "results"] = {
+                self.resultsKey(noChange, voters.ballots[self.__class__, "hon"][noChange], {}):
+                    (list(hon["results"]), dict(self.__class__.extraEvents))}
 
         stratTally = SideTally()
 
@@ -218,6 +366,7 @@ class Method:
                 [self.resultsFor(voters, self.ballotChooserFor(chooserFun), aTally)
                     for (chooserFun, aTally) in zip(chooserFuns, extraTallies)]
                   )
+        voters.ballots.forget(self.__class__)
         return ([(hon["results"], hon["chooser"],
                         list(self.__class__.extraEvents.items()))]  +
                 [(r["results"], r["chooser"], r["tally"].itemList()) for r in results])
@@ -263,7 +412,7 @@ class Method:
             for (i, (k, v)) in enumerate(tallyItems):
                 #print("Result: tally ",i,k,v)
                 row["tallyName"+str(i)] = str(k)
-                row["tallyVal"+str(i)] = str(v)
+                row["tallyVal"+str(i)] = v
             rows.append(row)
         # if len(multiResults[1]):
         #     row = {
@@ -285,7 +434,8 @@ class Method:
         """Takes a chooserFun; returns a ballot chooser using that chooserFun
         """
         def ballotChooser(cls, voter, tally):
-            return getattr(voter, cls.__name__ + "_" + chooserFun(cls, voter, tally))
+            return voter.storedBallot(cls, chooserFun(cls, voter, tally))
+        ballotChooser.kinds = chooserFun.allKinds #pick them all at once; see resultsFor
         ballotChooser.__name__ = chooserFun.getName()
         return ballotChooser
 
@@ -323,28 +473,135 @@ class Method:
 @decorator
 def rememberBallot(fun):
     """A decorator for a function of the form xxxBallot(cls, voter)
-    which memoizes the vote onto the voter in an attribute named <methName>_xxx
+    which memoizes the vote in the voter's electorate's BallotStore,
+    under (cls, "xxx")
+
+    If fun is marked wholeElectorate, the decorated function also has
+    allBallots(cls, voters), which stores and returns the whole electorate's
+    ballots as one array; Method.resultsFor tallies that directly.
     """
+    kind = fun.__name__[:-6] #leave off the "...Ballot"
     def getAndRemember(cls, voter, tally=None):
         ballot = fun(cls, voter)
-        setattr(voter, cls.__name__ + "_" + fun.__name__[:-6], ballot) #leave off the "...Ballot"
+        if hasattr(voter, "rowIndex"): #a lone voter has nowhere to keep it
+            voter.elec.ballots.put(cls, kind, voter.rowIndex, ballot)
         return ballot
+    if getattr(fun, "wholeElectorate", False):
+        def allBallots(cls, voters):
+            ballots = fun(cls, voters)
+            voters.ballots.putAll(cls, kind, ballots)
+            return ballots
+        getAndRemember.allBallots = allBallots
     getAndRemember.__name__ = fun.__name__
     getAndRemember.allTallyKeys = lambda:[]
     return getAndRemember
 
 @decorator
 def rememberBallots(fun):
-    """A decorator for a function of the form xxxBallot(cls, voter)
-    which memoizes the vote onto the voter in an attribute named <methName>_xxx
+    """A decorator for a function of the form xxxBallot(cls, voter) returning
+    a dict of ballots (and other per-voter values) by kind; memoizes each in
+    the voter's electorate's BallotStore, and returns the "xxx" one.
+
+    Kinds that are costly and not every chooser wants can be declared on the
+    decorated function as variants = {kind: kindBallot(cls, voter)}; those are
+    only built, for the whole electorate, if a chooser asks for them. Another
+    xxxBallot (eg for new polls) declaring the same kinds replaces them.
+
+    As with rememberBallot, a wholeElectorate fun gets allBallots(cls, voters).
     """
+    kind = fun.__name__[:-6] #leave off the "...Ballot"
+    def declareVariants(cls, store, voters):
+        for bType, variant in getattr(getAndRemember, "variants", {}).items():
+            store.declare(cls, bType, variant, voters) #once per variant
     def getAndRemember(cls, voter, tally=None):
         ballots = fun(cls, voter)
-        for bType, ballot in ballots.items():
-
-            setattr(voter, cls.__name__ + "_" + bType, ballot)
-
-        return ballots[fun.__name__[:-6]] #leave off the "...Ballot"
+        if hasattr(voter, "rowIndex"):
+            store = voter.elec.ballots
+            for bType, ballot in ballots.items():
+                store.put(cls, bType, voter.rowIndex, ballot)
+            declareVariants(cls, store, voter.elec)
+        return ballots[kind]
+    if getattr(fun, "wholeElectorate", False):
+        def allBallots(cls, voters):
+            ballots = fun(cls, voters)
+            for bType, values in ballots.items():
+                voters.ballots.putAll(cls, bType, values)
+            declareVariants(cls, voters.ballots, voters)
+            return ballots[kind]
+        getAndRemember.allBallots = allBallots
     getAndRemember.__name__ = fun.__name__
     getAndRemember.allTallyKeys = lambda:[]
     return getAndRemember
+
+def compressBallots(ballots):
+    """Returns (distinct ballots, how many voters cast each), a profile any
+    results method takes as results(ballots, weights=counts), so that the
+    tally scales with distinct ballots rather than voters.
+
+    >>> ballots, counts = compressBallots([[0, 1], [1, 0], [0, 1]])
+    >>> ballots.tolist(), counts.tolist()
+    ([[0, 1], [1, 0]], [2, 1])
+    """
+    return np.unique(np.asarray(ballots), axis=0, return_counts=True)
+
+def weightedMean(scores, weights=None):
+    """mean, or given weights, the weighted mean: a candScore for rated methods."""
+    if weights is None:
+        return mean(scores)
+    return np.average(scores, weights=weights)
+
+def wholeElectorate(fun):
+    """Marks a xxxBallot(cls, voter) whose ballots come from electorateBallots,
+    so that it can also be called with a whole ArrayElectorate. Put it under
+    rememberBallot(s), which then give the function an allBallots(cls, voters).
+    """
+    fun.wholeElectorate = True
+    return fun
+
+def electorateBallots(cls, voter, kind, buildAll):
+    """Returns voter's ballot of the given kind, out of buildAll(voters), which
+    makes the ballots for a whole electorate in one pass. buildAll gets the
+    ArrayElectorate (so it can use its cached prefOrders) or, for a lone voter,
+    a one-row utility array; either way np.asarray gives the (nvot, ncand)
+    utilities.
+
+    buildAll runs once per electorate for each (cls, kind), and the result is
+    kept on the electorate. Ballots come back as lists (and flags as python
+    scalars), as the per-voter API always gave them. If buildAll returns a dict
+    of arrays, this returns the dict of voter's entries. Given the whole
+    ArrayElectorate instead of one of its voters, it returns buildAll's arrays
+    as they are; see wholeElectorate.
+
+    >>> electorateBallots(Method, Voter([1, 2]), "hon", lambda utils: 2 * utils)
+    [2.0, 4.0]
+    >>> elec = ArrayElectorate([[1, 2], [3, 4]])
+    >>> calls = []
+    >>> def build(voters):
+    ...     calls.append(1)
+    ...     utils = np.asarray(voters, dtype=float)
+    ...     return dict(hon=utils, isBig=utils[:, 0] > 2)
+    >>> [electorateBallots(Method, v, "hon", build) for v in elec], len(calls)
+    ([{'hon': [1.0, 2.0], 'isBig': False}, {'hon': [3.0, 4.0], 'isBig': True}], 1)
+    >>> electorateBallots(Method, elec, "hon", build)["isBig"], len(calls)
+    (array([False,  True]), 1)
+    """
+    if hasattr(voter, "ballots"): #the whole electorate
+        elec, i = voter, None
+    else:
+        try:
+            elec, i = voter.elec, voter.rowIndex
+        except AttributeError:
+            elec, i = None, 0
+    if elec is None:
+        ballots = buildAll(np.array([voter], dtype=float))
+    else:
+        cache = elec.ballots.built
+        try:
+            ballots = cache[cls, kind]
+        except KeyError:
+            ballots = cache[cls, kind] = buildAll(elec)
+    if i is None:
+        return ballots
+    if isinstance(ballots, dict):
+        return {bType: ballot[i].tolist() for bType, ballot in ballots.items()}
+    return ballots[i].tolist()
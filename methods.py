@@ -1,6 +1,7 @@
 
 from mydecorators import autoassign, cached_property, setdefaultattr, decorator
 import random
+import numpy as np
 from numpy.lib.scimath import sqrt
 from numpy.core.fromnumeric import mean, std
 from numpy.lib.function_base import median
@@ -22,7 +23,14 @@ from dataClasses import *
 
 ####EMs themselves
 class Borda(Method):
-    candScore = staticmethod(mean)
+    candScore = staticmethod(weightedMean)
+
+    def tallyStat(self, ballots):
+        """Each candidate's total score."""
+        return np.asarray(ballots, dtype=float).sum(axis=0)
+
+    def statResults(self, totals, nvot):
+        return list(totals / nvot)
 
     nRanks = 999 # infinity
 
@@ -34,11 +42,18 @@ class Borda(Method):
             remainderScore=None #what to give candidates that don't fit in nSlots
             ):
 
-        venum = list(enumerate(voter))
+        prefOrder = voter.prefOrder #high to low
         if whichCands:
-            venum = [venum[c] for c in whichCands]
-        prefOrder = sorted(venum,key=lambda x:-x[1]) #high to low
-        Borda.fillCands(ballot, prefOrder, lowSlot, nSlots, remainderScore)
+            whichCands = set(whichCands)
+            prefOrder = [c for c in prefOrder if c in whichCands]
+        if nSlots is None:
+            nSlots = len(prefOrder)
+        cur = lowSlot + nSlots - 1
+        for i, cand in enumerate(prefOrder):
+            if i < nSlots:
+                ballot[cand] = cur - i
+            elif remainderScore is not None:
+                ballot[cand] = remainderScore
         #modifies ballot argument, returns nothing.
 
     @staticmethod
@@ -61,12 +76,25 @@ class Borda(Method):
                 i += 1
         #modifies ballot argument, returns nothing.
 
+    @staticmethod
+    def honBallots(voters):
+        """Honest rankings (ncand-1 for the favorite, down to 0) for a whole
+        electorate, from its prefOrders.
+
+        >>> Borda.honBallots([[4,1,6,3],[1,2,3,4]])
+        array([[2, 0, 3, 1],
+               [0, 1, 2, 3]])
+        """
+        order = rankingOf(voters)
+        ballots = np.empty_like(order)
+        np.put_along_axis(ballots, order, np.arange(order.shape[1] - 1, -1, -1), axis=1)
+        return ballots
+
     @staticmethod #cls is provided explicitly, not through binding
     @rememberBallot
+    @wholeElectorate
     def honBallot(cls, utils):
-        ballot = [0] * len(utils)
-        cls.fillPrefOrder(utils, ballot)
-        return ballot
+        return electorateBallots(cls, utils, "hon", cls.honBallots)
 
 
     @classmethod
@@ -103,6 +131,7 @@ class Plurality(RankedMethod):
 
     @staticmethod #cls is provided explicitly, not through binding
     @rememberBallot
+    @wholeElectorate
     def honBallot(cls, utils):
         """Takes utilities and returns an honest ballot
 
@@ -112,10 +141,15 @@ class Plurality(RankedMethod):
         [0, 1, 0]
         """
         #return cls.oneVote(utils, cls.winner(utils))
-        ballot = [0] * len(utils)
-        cls.fillPrefOrder(utils, ballot,
-            nSlots = 1, lowSlot=1, remainderScore=0)
-        return ballot
+        return electorateBallots(cls, utils, "hon", cls.honBallots)
+
+    @staticmethod
+    def honBallots(voters):
+        """Honest ballots for a whole electorate: 1 for each voter's favorite."""
+        order = rankingOf(voters)
+        ballots = np.zeros_like(order)
+        ballots[np.arange(len(order)), order[:, 0]] = 1
+        return ballots
     #
     # @classmethod
     # def xxstratBallot(cls, voter, polls, places, n,
@@ -142,28 +176,41 @@ class Plurality(RankedMethod):
 
 
 def Score(topRank=10, asClass=False):
+    """Score voting on 0..topRank: the method, or its class if asClass.
+
+    An indifferent voter's all-0 ballot still counts:
+        >>> Score().results(Score().honBallots([[5, 6, 7], [3, 3, 3]]))
+        [0.0, 2.5, 5.0]
+    """
     class Score0to(Method):
         """Score voting, 0-10.
 
 
         Strategy establishes pivots
             >>> Score().stratBallotFor([0,1,2])(Score, Voter([5,6,7]))
-            [0, 0, 10]
+            [0.0, 0.0, 10.0]
             >>> Score().stratBallotFor([2,1,0])(Score, Voter([5,6,7]))
-            [0, 10, 10]
+            [0.0, 10.0, 10.0]
             >>> Score().stratBallotFor([1,0,2])(Score, Voter([5,6,7]))
-            [0, 5.0, 10]
+            [0.0, 5.0, 10.0]
 
         Strategy (kinda) works for ties
             >>> Score().stratBallotFor([1,0,2])(Score, Voter([5,6,6]))
-            [0, 10, 10]
+            [0.0, 10.0, 10.0]
             >>> Score().stratBallotFor([1,0,2])(Score, Voter([6,6,7]))
-            [0, 0, 10]
+            [0.0, 0.0, 10.0]
             >>> Score().stratBallotFor([1,0,2])(Score, Voter([6,7,6]))
-            [10, 10, 10]
+            [10.0, 10.0, 10.0]
             >>> Score().stratBallotFor([1,0,2])(Score, Voter([6,5,6]))
-            [10, 0, 10]
-
+            [10.0, 0.0, 10.0]
+
+        The whole-electorate versions take an (nvot, ncand) utility array
+            >>> Score().honBallots(np.array([[5,6,7],[7,5,6]]))
+            array([[ 0.,  5., 10.],
+                   [10.,  0.,  5.]])
+            >>> Score().stratBallots(np.array([[5,6,7],[6,7,6]]), [1,0,2])["strat"]
+            array([[ 0.,  5., 10.],
+                   [10., 10., 10.]])
         """
 
         #>>> qs += [Score().resultsFor(PolyaModel()(101,2),Score.honBallot)[0] for i in range(800)]
@@ -178,7 +225,10 @@ def Score(topRank=10, asClass=False):
         #>>> std(qs5)
         #2.3536762480634343
         bias5 = 2.3536762480634343
-        candScore = staticmethod(mean)
+        candScore = staticmethod(weightedMean)
+
+        tallyStat = Borda.tallyStat
+        statResults = Borda.statResults
             #"""Takes the list of votes for a candidate; returns the candidate's score."""
 
 
@@ -187,8 +237,25 @@ def Score(topRank=10, asClass=False):
                 return "IdealApproval"
             return self.__class__.__name__ + str(self.topRank)
 
+        @classmethod
+        def honBallots(cls, utils):
+            """Honest ballots (on 0..topRank) for an electorate or (nvot, ncand)
+            utility array: each voter's range of utilities, stretched over the
+            scores. A voter who rates every candidate the same scores them all 0.
+
+                >>> Score().honBallots([[5, 6, 7], [3, 3, 3]]).tolist()
+                [[0.0, 5.0, 10.0], [0.0, 0.0, 0.0]]
+            """
+            utils = np.asarray(utils, dtype=float)
+            bot = utils.min(1, keepdims=True)
+            scale = utils.max(1, keepdims=True) - bot
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ballots = np.floor((cls.topRank + .99) * (utils - bot) / scale)
+            return np.where(scale == 0, 0., ballots)
+
         @staticmethod #cls is provided explicitly, not through binding
         @rememberBallot
+        @wholeElectorate
         def honBallot(cls, utils):
             """Takes utilities and returns an honest ballot (on 0..10)
 
@@ -199,30 +266,39 @@ def Score(topRank=10, asClass=False):
                 >>> Score().resultsFor(DeterministicModel(3)(5,3),Score().honBallot)["results"]
                 [4.0, 6.0, 5.0]
             """
-            bot = min(utils)
-            scale = max(utils)-bot
-            return [floor((cls.topRank + .99) * (util-bot) / scale) for util in utils]
+            return electorateBallots(cls, utils, "hon", cls.honBallots)
 
+        def stratBallots(self, utils, polls):
+            """Strategic ballots for an (nvot, ncand) utility array, given the
+            polls: each voter's scores are stretched between the utilities of the
+            two frontrunners (as picked by stratTargetFor), and clipped outside
+            them. A voter indifferent between those two approves everything at
+            least as good.
 
-        @classmethod
-        def fillStratBallot(cls, voter, polls, places, n, stratGap, ballot,
-                            frontId, frontResult, targId, targResult):
+            Returns dict(strat=<ballots>, isStrat=<prefers the target>,
+            stratGap=<utility of target minus that of frontrunner>), by voter.
+            """
+            utils = np.asarray(utils, dtype=float)
+            places = sorted(enumerate(polls),key=lambda x:-x[1]) #from high to low
+            (frontId, frontResult, targId, targResult) = self.stratTargetFor(places)
+            stratGap = utils[:, targId] - utils[:, frontId]
+            hi = np.maximum(utils[:, frontId], utils[:, targId])[:, np.newaxis]
+            lo = np.minimum(utils[:, frontId], utils[:, targId])[:, np.newaxis]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                stretched = np.clip(np.floor((self.topRank + .99) * (utils - lo) / (hi - lo)),
+                                    0, self.topRank)
+            strat = np.where(hi == lo, np.where(utils >= hi, self.topRank, 0), stretched)
+            return dict(strat=strat.astype(float), isStrat=stratGap > 0, stratGap=stratGap)
+
+        def stratBallotFor(self, polls):
             """Returns a (function which takes utilities and returns a strategic ballot)
             for the given "polling" info."""
-
-            cuts = [voter[frontId], voter[targId]]
-            if stratGap > 0:
-                #sort cuts high to low
-                cuts = (cuts[1], cuts[0])
-            if cuts[0] == cuts[1]:
-                strat = [(cls.topRank if (util >= cuts[0]) else 0) for util in voter]
-            else:
-                strat = [max(0,min(cls.topRank,floor(
-                                (cls.topRank + .99) * (util-cuts[1]) / (cuts[0]-cuts[1])
-                            )))
-                        for util in voter]
-            for i in range(n):
-                ballot[i] = strat[i]
+            @rememberBallots
+            @wholeElectorate
+            def stratBallot(cls, voter):
+                return electorateBallots(cls, voter, ("strat", tuple(polls)),
+                                         lambda utils: self.stratBallots(utils, polls))
+            return stratBallot
 
     Score0to.topRank = topRank
     if asClass:
@@ -240,6 +316,7 @@ def BulletyApprovalWith(bullets=0.5, asClass=False):
 
         @staticmethod #cls is provided explicitly, not through binding
         @rememberBallot
+        @wholeElectorate
         def honBallot(cls, utils):
             """Takes utilities and returns an honest ballot (on 0..10)
 
@@ -250,10 +327,18 @@ def BulletyApprovalWith(bullets=0.5, asClass=False):
                 >>> Score().resultsFor(DeterministicModel(3)(5,3),Score().honBallot)["results"]
                 [4.0, 6.0, 5.0]
             """
-            if random.random() > cls.bulletiness:
-                return cls.__bases__[0].honBallot(cls, utils)
-            best = max(utils)
-            return [1 if util==best else 0 for util in utils]
+            return electorateBallots(cls, utils, "hon", cls.honBallots)
+
+        @classmethod
+        def honBallots(cls, utils):
+            """Honest ballots for an electorate or (nvot, ncand) utility array:
+            each voter, with probability bulletiness, approves only their
+            favorite(s)."""
+            utils = np.asarray(utils, dtype=float)
+            bullet = defaultRng().random(len(utils)) <= cls.bulletiness
+            favorites = (utils == utils.max(1, keepdims=True))
+            return np.where(bullet[:, np.newaxis], favorites,
+                            super(BulletyApproval, cls).honBallots(utils))
 
     if asClass:
         return BulletyApproval
@@ -268,8 +353,9 @@ def Srv(topRank=10):
     class Srv0to(score0to):
 
         stratTargetFor = Method.stratTarget3
+        tallyStat = None #the runoff isn't a sum; results recounts
 
-        def results(self, ballots, **kwargs):
+        def results(self, ballots, *, weights=None, marginCache=None, **kwargs):
             """Srv results.
 
             >>> Srv().resultsFor(DeterministicModel(3)(5,3),Irv().honBallot)["results"]
@@ -280,16 +366,77 @@ def Srv(topRank=10):
             0
             >>> Srv().results([[0,1,2]] * 4 + [[2,1,0]] * 3 + [[1,2,0]] * 2)
             [2, 0, 1]
+            >>> ballots = [[0,1,2]] * 4 + [[2,1,0]] * 3 + [[1,2,0]] * 2
+            >>> distinct, counts = compressBallots(ballots)
+            >>> Srv().results(distinct, weights=counts) == Srv().results(ballots)
+            True
             """
-            baseResults = super(Srv0to, self).results(ballots, **kwargs)
+            baseResults = super(Srv0to, self).results(ballots, weights=weights, **kwargs)
             (runnerUp,top) = sorted(range(len(baseResults)), key=lambda i: baseResults[i])[-2:]
-            upset = sum(sign(ballot[runnerUp] - ballot[top]) for ballot in ballots)
+            upset = pairwiseMargins(ballots, weights, marginCache)[runnerUp, top]
             if upset > 0:
                 baseResults[runnerUp] = baseResults[top] + 0.01
             return baseResults
     return Srv0to()
 
 
+def pairwiseMargins(ballots, weights=None, cache=None):
+    """Returns an (ncand, ncand) array whose [i, j] entry is the number of
+    ballots rating i above j, minus the number rating j above i; with weights,
+    each ballot counts as that many. The array is read-only.
+
+    Methods tallying the same ballots (eg honest Schulze and Rp) can share the
+    result through cache, a dict keyed by ballot contents; Method.resultsOf
+    passes the election's, BallotStore.margins.
+
+        >>> pairwiseMargins([[0,1,2]] * 4 + [[2,1,0]] * 3 + [[1,2,0]] * 2)
+        array([[ 0, -3,  1],
+               [ 3,  0,  1],
+               [-1, -1,  0]])
+        >>> cache = dict()
+        >>> m = pairwiseMargins([[0,1,2],[2,1,0]], cache=cache)
+        >>> pairwiseMargins([[0,1,2],[2,1,0]], cache=cache) is m, m.flags.writeable
+        (True, False)
+    """
+    ballots = np.asarray(ballots, dtype=float)
+    if weights is None:
+        weights = np.ones(len(ballots), dtype=int)
+    weights = np.asarray(weights)
+    key = (ballots.shape, ballots.tobytes(), weights.tobytes())
+    if cache is not None and key in cache:
+        return cache[key]
+    ncand = ballots.shape[1]
+    margins = np.empty((ncand, ncand), dtype=weights.dtype)
+    for i in range(ncand):
+        margins[i] = weights @ np.sign(ballots[:, i:i+1] - ballots)
+    margins.flags.writeable = False
+    if cache is not None:
+        cache[key] = margins
+    return margins
+
+def isGradeArray(scores):
+    """Whether scores are all small whole numbers >= 0, so can be bincounted."""
+    return (scores.size > 0 and scores.dtype != object and scores.min() >= 0
+            and scores.max() < 1000 and (scores == np.floor(scores)).all())
+
+def gradeCounts(scores, weights=None):
+    """Returns (grades, counts): the histogram of scores, with the grades in
+    increasing order and counts[k] the number (or total weight) of voters who
+    gave grades[k]. The usual small whole-number grades are counted with
+    bincount; anything else goes through np.unique.
+
+        >>> gradeCounts([3, 1, 3])
+        (array([0, 1, 2, 3]), array([0, 1, 0, 2]))
+        >>> gradeCounts([0.5, -1, 0.5], [1, 2, 3])
+        (array([-1. ,  0.5]), array([2., 4.]))
+    """
+    scores = np.asarray(scores)
+    if isGradeArray(scores):
+        counts = np.bincount(scores.astype(int), weights)
+        return np.arange(len(counts)), counts
+    grades, which = np.unique(scores, return_inverse=True)
+    return grades, np.bincount(which.ravel(), weights)
+
 def toVote(cutoffs, util):
     """maps one util to a vote, using cutoffs.
 
@@ -320,7 +467,7 @@ class Mav(Method):
     specificCuts = None
     specificPercentiles = [25,50,75,90]
 
-    def candScore(self, scores):
+    def candScore(self, scores, weights=None):
         """For now, only works correctly for odd nvot
 
         Basic tests
@@ -336,18 +483,59 @@ class Mav(Method):
             1.5
             >>> Mav().candScore([1,2,3,3,5])
             2.7
+            >>> Mav().candScore([1,2,3,5], [1,1,2,1])
+            2.7
             """
-        scores = sorted(scores)
-        nvot = len(scores)
+        return self.histScore(*gradeCounts(scores, weights))
+
+    def histScore(self, grades, counts):
+        """candScore, from a histogram: counts[k] voters gave grade grades[k]
+        (grades in increasing order)."""
+        cumCounts = np.cumsum(counts)
+        nvot = cumCounts[-1].item()
         nGrades = (len(self.baseCuts) + 1)
         i = int((nvot - 1) / 2)
-        base = scores[i]
-        while (i < nvot and scores[i] == base):
-            i += 1
+        median = np.searchsorted(cumCounts, i, side="right") #first grade past voter i
+        base = grades[median].item()
+        i = cumCounts[median].item() #voters at or below the median grade
         upper =  (base + 0.5) - (i - nvot/2) * nGrades / nvot
         lower = (base) - (i - nvot/2) / nvot
         return max(upper, lower)
 
+    def results(self, ballots, *, weights=None, **kwargs):
+        """Scores every candidate from one bincount of (candidate, grade)
+        pairs over the whole ballot matrix.
+
+            >>> Mav().results([[0,4,2],[1,3,2],[2,3,2],[0,4,2],[4,1,2]])
+            [1.0, 3.0, 1.5]
+        """
+        ballots = np.asarray(ballots)
+        if not isGradeArray(ballots):
+            return super().results(ballots, weights=weights, **kwargs)
+        return self.statResults(self.gradeHist(ballots, int(ballots.max()) + 1, weights), None)
+
+    @staticmethod
+    def gradeHist(ballots, nGrades, weights=None):
+        """(ncand, nGrades) array: how many voters gave each candidate each grade."""
+        ncand = ballots.shape[1]
+        codes = ballots.astype(int) + nGrades * np.arange(ncand)
+        if weights is not None:
+            weights = np.repeat(weights, ncand) #one per code, row by row
+        hist = np.bincount(codes.ravel(), weights, minlength=ncand * nGrades)
+        return hist.reshape(ncand, nGrades)
+
+    maxGrade = 10 #extraStrat ballots go up to 10
+
+    def tallyStat(self, ballots):
+        """The gradeHist, if ballots are all whole grades up to maxGrade."""
+        if not isGradeArray(ballots) or ballots.max() > self.maxGrade:
+            return None
+        return self.gradeHist(ballots, self.maxGrade + 1)
+
+    def statResults(self, hist, nvot):
+        grades = np.arange(hist.shape[1])
+        return [self.histScore(grades, counts) for counts in hist]
+
     @classmethod
     def honBallotFor(cls, voters):
         cls.specificCuts = percentile(voters,cls.specificPercentiles)
@@ -355,6 +543,7 @@ class Mav(Method):
 
     @staticmethod #cls is provided explicitly, not through binding
     @rememberBallot
+    @wholeElectorate
     def honBallot(cls, voter):
         """Takes utilities and returns an honest ballot (on 0..4)
 
@@ -367,19 +556,36 @@ class Mav(Method):
             [0, 1, 4]
         """
         cuts = cls.specificCuts if (cls.specificCuts is not None) else cls.baseCuts
-        cuts = [min(cut, max(voter) - 0.001) for cut in cuts]
-        return [toVote(cuts, util) for util in voter]
+        return electorateBallots(cls, voter, ("hon", tuple(cuts)),
+                                 lambda voters: cls.honBallots(voters, cuts))
+
+    @staticmethod
+    def honBallots(voters, cuts):
+        """Honest grades for a whole electorate: each voter's cuts are clamped
+        to just below their favorite's utility, and each utility's grade is the
+        number of (clamped) cuts below it -- what toVote gives, for all voters
+        at once.
+
+            >>> Mav.honBallots([[-1,-0.5,0.5,1,1.1], [-1,-0.5,0.5,0,0]], Mav.baseCuts)
+            array([[0, 1, 2, 3, 4],
+                   [0, 1, 4, 1, 1]])
+        """
+        utils = np.asarray(voters, dtype=float)
+        cuts = np.minimum(np.asarray(cuts, dtype=float)[np.newaxis, :],
+                          utils.max(axis=1, keepdims=True) - 0.001)
+        return (utils[:, :, np.newaxis] > cuts[:, np.newaxis, :]).sum(axis=2)
 
 
     def stratBallotFor(self, polls):
         """Returns a function which takes utilities and returns a dict(
             strat=<ballot in which all grades are exaggerated
                              to outside the range of the two honest frontrunners>,
-            extraStrat=<ballot in which all grades are exaggerated to extremes>,
             isStrat=<whether the runner-up is preferred to the frontrunner (for reluctantStrat)>,
             stratGap=<utility of runner-up minus that of frontrunner>
             )
-        for the given "polling" info.
+        for the given "polling" info. It also declares the variant
+            extraStrat=<ballot in which all grades are exaggerated to extremes>,
+        which is only built if a chooser asks for it.
 
 
 
@@ -398,6 +604,15 @@ class Mav(Method):
             [4, 0, 4]
             >>> Mav().stratBallotFor([2.1,0,3])(Mav, Voter([6,5,6.1]))
             [2, 2, 4]
+
+        Polling a stored electorate again rebuilds extraStrat for the new polls:
+            >>> e = DeterministicModel(3)(3, 3)
+            >>> for polls in [3,2,1], [1,2,3]:
+            ...     stratBallot = Mav().stratBallotFor(polls)
+            ...     strat = [stratBallot(Mav, v) for v in e]
+            ...     print(e.ballots[Mav, "extraStrat"].tolist())
+            [[0.0, 4.0, 9.0], [0.0, 4.0, 0.0], [4.0, 0.0, 2.0]]
+            [[0.0, 0.0, 4.0], [2.0, 4.0, 0.0], [9.0, 0.0, 4.0]]
         """
         places = sorted(enumerate(polls),key=lambda x:-x[1]) #from high to low
         #print("places",places)
@@ -407,8 +622,8 @@ class Mav(Method):
         def stratBallot(cls, voter):
             frontUtils = [voter[frontId], voter[targId]] #utils of frontrunners
             stratGap = frontUtils[1] - frontUtils[0]
-            if stratGap is 0:
-                strat = extraStrat = [(4 if (util >= frontUtils[0]) else 0)
+            if stratGap == 0:
+                strat = [(4 if (util >= frontUtils[0]) else 0)
                                      for util in voter]
                 isStrat = True
 
@@ -432,17 +647,27 @@ class Mav(Method):
                               ))
                            for i in range(len(self.baseCuts))]
                 strat = [toVote(cutoffs, util) for util in voter]
-                extraStrat = [max(0,min(10,floor(
-                                4.99 * (util-frontUtils[1]) / (frontUtils[0]-frontUtils[1])
-                            )))
-                        for util in voter]
-            return dict(strat=strat, extraStrat=extraStrat, isStrat=isStrat,
+            return dict(strat=strat, isStrat=isStrat,
                         stratGap = stratGap)
+
+        def extraStratBallot(cls, voter):
+            frontUtils = [voter[frontId], voter[targId]] #utils of frontrunners
+            stratGap = frontUtils[1] - frontUtils[0]
+            if stratGap == 0:
+                return [(4 if (util >= frontUtils[0]) else 0) for util in voter]
+            if stratGap > 0:
+                frontUtils = (frontUtils[1], frontUtils[0]) #high to low
+            return [max(0,min(10,floor(
+                            4.99 * (util-frontUtils[1]) / (frontUtils[0]-frontUtils[1])
+                        )))
+                    for util in voter]
+
+        stratBallot.variants = dict(extraStrat=extraStratBallot) #only if a chooser wants it
         return stratBallot
 
 
 class Mj(Mav):
-    def candScore(self, scores):
+    def candScore(self, scores, weights=None):
         """This formula will always give numbers within 0.5 of the raw median.
         Unfortunately, with 5 grade levels, these will tend to be within 0.1 of
         the raw median, leaving scores further from the integers mostly unused.
@@ -467,15 +692,21 @@ class Mj(Mav):
             3.02
             >>> Mj().candScore([3] * 13 + [4] * 12)
             3.46
+            >>> Mj().candScore([3, 4], [13, 12])
+            3.46
             """
-        scores = sorted(scores)
-        nvot = len(scores)
-        lo = hi = mid = nvot // 2
-        base = scores[mid]
-        while (hi < nvot and scores[hi] == base):
-            hi += 1
-        while (lo >= 0 and scores[lo] == base):
-            lo -= 1
+        return self.histScore(*gradeCounts(scores, weights))
+
+    def histScore(self, grades, counts):
+        """candScore, from a histogram: counts[k] voters gave grade grades[k]
+        (grades in increasing order)."""
+        cumCounts = np.cumsum(counts)
+        nvot = cumCounts[-1].item()
+        mid = nvot // 2
+        median = np.searchsorted(cumCounts, mid, side="right") #first grade past voter mid
+        base = grades[median].item()
+        hi = cumCounts[median].item() #first voter above the median grade
+        lo = hi - counts[median].item() - 1 #last voter below it
 
         if (hi-mid) == (mid-lo):
             return base
@@ -492,27 +723,17 @@ class Irv(Method):
     """
 
     stratTargetFor = Method.stratTarget3
+    randomResults = True #ties for last place are drawn by winner
 
-    def resort(self, ballots, loser, ncand, piles):
-        """No error checking; only works for exhaustive ratings."""
-        #print("resort",ballots, loser, ncand)
-        #print(piles)
-        for ballot in ballots:
-            if loser < 0:
-                nextrank = ncand - 1
-            else:
-                nextrank = ballot[loser] - 1
-            while 1:
-                try:
-                    piles[ballot.index(nextrank)].append(ballot)
-                    break
-                except AttributeError:
-                    nextrank -= 1
-                    if nextrank < 0:
-                        raise
-
-    def results(self, ballots, **kwargs):
-        """IRV results.
+    def results(self, ballots, *, weights=None, **kwargs):
+        """IRV results: the round in which each candidate is eliminated
+        (ncand - 1 for the winner). Ballots must rank every candidate.
+
+        Each ballot has a pointer into its preference order and counts for the
+        candidate there. First preferences are counted with bincount; when a
+        candidate is eliminated, the pointers of its ballots skip ahead past
+        eliminated candidates and those ballots are counted again. Ties for
+        last place are broken by self.winner, as for any method.
 
         >>> Irv().resultsFor(DeterministicModel(3)(5,3),Irv().honBallot)["results"]
         [0, 1, 2]
@@ -522,38 +743,50 @@ class Irv(Method):
         0
         >>> Irv().results([[0,1,2]] * 4 + [[2,1,0]] * 3 + [[1,2,0]] * 2)
         [2, 0, 1]
+        >>> Irv().results([[0,1,2], [2,1,0], [1,2,0]], weights=[4,3,2])
+        [2, 0, 1]
         """
-        if type(ballots) is not list:
-            ballots = list(ballots)
-        ncand = len(ballots[0])
+        ballots = np.asarray(ballots, dtype=int)
+        nvot, ncand = ballots.shape
+        if weights is not None:
+            weights = np.asarray(weights)
+        prefs = np.empty_like(ballots) #candidates, high to low
+        np.put_along_axis(prefs, ncand - 1 - ballots, np.arange(ncand)[np.newaxis], axis=1)
+        pointers = np.zeros(nvot, dtype=int)
+        tops = prefs[:, 0].copy()
+        counts = np.bincount(tops, weights, minlength=ncand)
+        eliminated = np.zeros(ncand, dtype=bool)
         results = [-1] * ncand
-        piles = [[] for i in range(ncand)]
-        loserpile = ballots
-        loser = -1
         for i in range(ncand):
-            self.resort(loserpile, loser, ncand, piles)
-            negscores = ["x" if isnum(pile) else -len(pile)
-                         for pile in piles]
+            negscores = ["x" if eliminated[c] else -count
+                         for c, count in enumerate(counts.tolist())]
             loser = self.winner(negscores)
             results[loser] = i
-            loserpile, piles[loser] = piles[loser], -1
+            eliminated[loser] = True
+            if i == ncand - 1:
+                break
+            moved = moving = np.flatnonzero(tops == loser)
+            while len(moving):
+                pointers[moving] += 1
+                tops[moving] = prefs[moving, pointers[moving]]
+                moving = moving[eliminated[tops[moving]]]
+            counts[loser] = 0
+            counts += np.bincount(tops[moved], None if weights is None else weights[moved],
+                                  minlength=ncand)
         return results
 
-
     @staticmethod #cls is provided explicitly, not through binding
     @rememberBallot
+    @wholeElectorate
     def honBallot(cls, voter):
         """Takes utilities and returns an honest ballot
 
         >>> Irv.honBallot(Irv,Voter([4,1,6,3]))
         [2, 0, 3, 1]
         """
-        ballot = [-1] * len(voter)
-        order = sorted(enumerate(voter), key=lambda x:x[1])
-        for i, cand in enumerate(order):
-            ballot[cand[0]] = i
-        #print("hballot",ballot)
-        return ballot
+        return electorateBallots(cls, voter, "hon", cls.honBallots)
+
+    honBallots = staticmethod(Borda.honBallots)
 
 
     @classmethod
@@ -587,12 +820,15 @@ class Irv(Method):
         assert i == -1
 
 class V321(Mav):
+    extraEventKeys = ("3beats1", "3beats2", "4beats1")
     baseCuts = [-.1,.8]
     specificPercentiles = [45, 75]
 
     stratTargetFor = Method.stratTarget3
+    tallyStat = None #results has its own rules, not Mav's histogram
 
-    def results(self, ballots, isHonest=False, **kwargs):
+    def results(self, ballots, *, isHonest=False, weights=None, marginCache=None,
+                **kwargs):
         """3-2-1 Voting results.
 
         >>> V321().resultsFor(DeterministicModel(3)(5,3),V321().honBallot)["results"]
@@ -607,44 +843,47 @@ class V321(Mav):
         [3, 0.5, 1, 0]
         >>> V321().results([[1,0,2,1]]*29 + [[0,2,1,1]]*30 + [[2,1,0,1]]*31 + [[1,1,1,2]]*10)
         [3.375, 2.875, 0.25, 0]
+        >>> V321().results([[1,0,2,1],[0,2,1,1],[2,1,0,1],[1,1,1,2]], weights=[29,30,31,10])
+        [3.375, 2.875, 0.25, 0]
+        >>> ballots = [[0,1,2,1]]*29 + [[1,2,0,1]]*30 + [[2,0,1,1]]*31 + [[1,1,1,2]]*10
+        >>> distinct, counts = compressBallots(ballots)
+        >>> V321().results(distinct, weights=counts) == V321().results(ballots)
+        True
         """
-        candScores = list(zip(*ballots))
-        n2s = [sum(1 if s>1 else 0 for s in c) for c in candScores]
+        ballots = np.asarray(ballots, dtype=float)
+        if weights is None:
+            weights = np.ones(len(ballots), dtype=int)
+        n2s = weights @ (ballots > 1) #top ratings, by candidate
         o2s = argsort(n2s) #order
-        r2s = [-1] * len(n2s) #ranks
-        for r,i in enumerate(o2s):
-            r2s[i] = r
+        r2s = np.empty(len(n2s), dtype=int) #ranks
+        r2s[o2s] = np.arange(len(n2s))
+        r2s = r2s.tolist()
         semifinalists = o2s[-3:] #[third, second, first] by top ranks
-        #print(semifinalists)
-        n1s = [sum(1 if s>0 else 0 for s in candScores[sf]) for sf in semifinalists]
+        n1s = weights @ (ballots[:, semifinalists] > 0) #above-bottom ratings
         o1s = argsort(n1s)
-        #print("n1s",n1s)
-        #print("o1s",o1s)
-        #print([semifinalists[o] for o in o1s]) #[third, second, first] by above-bottom
-        #print("r2s",r2s)
+        #[semifinalists[o] for o in o1s] is [third, second, first] by above-bottom
         r2s[semifinalists[o1s[0]]] -= (o1s[0] +1) * .75 #non-finalist below finalists
         semiupset = o1s[1] < o1s[2] #semifinalist and finalist order are different
 
 
 
         (runnerUp,top) = semifinalists[o1s[1]], semifinalists[o1s[2]]
-        upset = sum(sign(ballot[runnerUp] - ballot[top]) for ballot in ballots)
+        margins = pairwiseMargins(ballots, weights, marginCache)
+        upset = margins[runnerUp, top]
         if upset > 0:
             runnerUp, top = top, runnerUp
             r2s[runnerUp], r2s[top] = r2s[top] - .125, r2s[runnerUp] + .125
         r2s[top] = max(r2s[top], r2s[runnerUp] + 0.5)
         if isHonest:
-            upset2 =  sum(sign(ballot[semifinalists[o1s[0]]] - ballot[semifinalists[o1s[2]]]) for ballot in ballots)
+            upset2 = margins[semifinalists[o1s[0]], semifinalists[o1s[2]]]
             self.__class__.extraEvents["3beats1"] = upset2 > 0
-            upset3 =  sum(sign(ballot[semifinalists[o1s[0]]] - ballot[semifinalists[o1s[1]]]) for ballot in ballots)
+            upset3 = margins[semifinalists[o1s[0]], semifinalists[o1s[1]]]
             self.__class__.extraEvents["3beats2"] = upset3 > 0
             if len(o2s) > 3:
                 fourth = o2s[-4]
-                fourthNotLasts = sum(1 if s>1 else 0 for s in candScores[fourth])
+                fourthNotLasts = n2s[fourth]
                 fourthWin = (fourthNotLasts > n1s[o1s[1]] and
-                             sum(sign(ballot[fourth] - ballot[semifinalists[o1s[2]]])
-                                    for ballot in ballots)
-                                > 0)
+                             margins[fourth, semifinalists[o1s[2]]] > 0)
                 self.__class__.extraEvents["4beats1"] = fourthWin
 
         return r2s
@@ -666,7 +905,7 @@ class V321(Mav):
         #@rememberBallots ... do it later
         def stratBallot(cls, voter):
             stratGap = voter[top3[1]] - voter[top3[0]]
-            myPrefs = [c for c,v in sorted(enumerate(voter),key=lambda x:-x[1])] #high to low
+            myPrefs = voter.prefOrder #high to low
             my3order = [myPrefs.index(c) for c in top3]
             rating = 2
             ballot = [0] * len(voter)
@@ -692,12 +931,11 @@ class V321(Mav):
             @rememberBallots
             def stratBallo2(cls, voter):
                 stratGap = voter[top3[1]] - voter[top3[0]]
-                myprefs = sorted(enumerate(voter),key=lambda x:-x[1]) #high to low
                 rating = 2
                 ballot = [None] * len(voter)
                 isStrat=False
                 stratGap = 0
-                for c, util in myprefs:
+                for c in voter.prefOrder: #high to low
                     ballot[c] = rating
                     if rating and (c in top3):
                         if (c == top3[2]):
@@ -716,13 +954,11 @@ class V321(Mav):
             @rememberBallots
             def stratBallo3(cls, voter):
                 stratGap = voter[top3[1]] - voter[top3[0]]
-                myprefs = sorted(enumerate(voter),key=lambda x:-x[1]) #high to low
-
                 rating = 2
                 ballot = [None] * len(voter)
                 if voter[fourth] > voter[first]:
 
-                    for c, util in myprefs:
+                    for c in voter.prefOrder: #high to low
                         ballot[c] = rating
                         if rating and (c == fourth):
                             rating -= 2
@@ -736,41 +972,59 @@ class V321(Mav):
         return rememberBallots(stratBallot)
 
 class Schulze(RankedMethod):
+    extraEventKeys = ("scenario",)
     def resolveCycle(self, cmat, n):
+        """Number of candidates each one beats by strongest beatpath (ties
+        going to the lower index), from the margin matrix cmat.
 
-        beatStrength = [[0] * n] * n
-        numWins = [0] * n
-        for i in range(n):
-            for j in range(n):
-                if (i != j):
-                    if cmat[i][j] > cmat[j][i]:
-                        beatStrength[i][j] = cmat[i][j]
-                    else:
-                        beatStrength[i][j] = 0
-
-                for i in range(n):
-                    for j in range(n):
-                        if (i != j):
-                            for k in range(n):
-                                if (i != k and j != k):
-                                    beatStrength[j][k] = max ( beatStrength[j][k],
-                                        min ( beatStrength[j][i], beatStrength[i][k] ) )
+        The strongest paths are found by Floyd-Warshall, one vectorized
+        max/min pass per intermediate candidate: O(n**3) in all.
 
+        Wikipedia's 45-voter example (as margins), where E wins, then A, C, B, D:
+            >>> d = np.array([[0,20,26,30,22],[25,0,16,33,18],[19,29,0,17,24],
+            ...               [15,12,28,0,14],[23,27,21,31,0]])
+            >>> Schulze().resolveCycle(d - d.T, 5)
+            [3, 1, 2, 0, 4]
+        """
+        cmat = np.asarray(cmat)
+        strength = np.where(cmat > cmat.T, cmat, 0) #direct wins only
+        for i in range(n):
+            strength = np.maximum(strength, np.minimum(strength[:, i:i+1], strength[i:i+1, :]))
+        beats = strength > strength.T
+        ties = (strength == strength.T) & np.triu(np.ones((n, n), dtype=bool), 1) #break ties deterministically
+        return (beats | ties).sum(axis=1).tolist()
+
+    def marginResults(self, cmat, n):
+        """(results, condOrder, cycle) from the margin matrix cmat: numbers of
+        pairwise wins if there's a Condorcet winner, else resolveCycle's."""
+        numWins = [0] * n
         for i in range(n):
             for j in range(n):
                 if i != j:
-                    if beatStrength[i][j]>beatStrength[j][i]:
+                    if cmat[i][j]>0:
                         numWins[i] += 1
-                    if beatStrength[i][j]==beatStrength[j][i] and i<j: #break ties deterministically
+                    elif cmat[i][j]==0 and i<j:
                         numWins[i] += 1
+        condOrder = sorted(enumerate(numWins),key=lambda x:-x[1])
+        if condOrder[0][1] == n-1:
+            cycle = 0
+            result = numWins
+        else: #cycle
+            cycle = 1
+            result = self.resolveCycle(cmat, n)
+        return result, condOrder, cycle
+
+    tallyStat = staticmethod(pairwiseMargins)
 
-        return numWins
+    def statResults(self, cmat, nvot):
+        return self.marginResults(cmat.tolist(), len(cmat))[0]
 
-    def results(self, ballots, isHonest=False, **kwargs):
+    def results(self, ballots, *, isHonest=False, weights=None, marginCache=None,
+                **kwargs):
         """Schulze results.
 
         >>> Schulze().resultsFor(DeterministicModel(3)(5,3),Schulze().honBallot,isHonest=True)["results"]
-        [2, 0, 1]
+        [1, 2, 0]
         >>> Schulze.extraEvents
         {'scenario': 'cycle'}
         >>> Schulze().results([[0,1,2]],isHonest=True)[2]
@@ -797,26 +1051,22 @@ class Schulze(RankedMethod):
         [3, 0, 1, 2]
         >>> Schulze.extraEvents
         {'scenario': 'spoiler'}
+        >>> Schulze().results([[3,0,0,0],[2,3,0,0],[0,0,0,3],[0,0,3,0]],isHonest=True,weights=[5,2,6,3])
+        [3, 0, 1, 2]
+        >>> Schulze.extraEvents
+        {'scenario': 'spoiler'}
+        >>> ballots = [[0,1,2]] * 4 + [[2,1,0]] * 2 + [[1,2,0]] * 3
+        >>> distinct, counts = compressBallots(ballots)
+        >>> Schulze().results(distinct, weights=counts) == Schulze().results(ballots)
+        True
+        >>> Schulze().results(distinct, isHonest=True, weights=counts), Schulze.extraEvents
+        ([1, 2, 0], {'scenario': 'squeeze'})
         """
+        if weights is None:
+            weights = [1] * len(ballots)
         n = len(ballots[0])
-        cmat = [[0 for i in range(n)] for j in range(n)]
-        numWins = [0] * n
-        for i in range(n):
-            for j in range(n):
-                if i != j:
-                    cmat[i][j] = sum(sign(ballot[i] - ballot[j]) for ballot in ballots)
-                    if cmat[i][j]>0:
-                        numWins[i] += 1
-                    elif cmat[i][j]==0 and i<j:
-                        numWins[i] += 1
-        condOrder = sorted(enumerate(numWins),key=lambda x:-x[1])
-        if condOrder[0][1] == n-1:
-            cycle = 0
-            result = numWins
-        else: #cycle
-            cycle = 1
-            result = self.resolveCycle(cmat, n)
-            order = None
+        cmat = pairwiseMargins(ballots, weights, marginCache).tolist()
+        result, condOrder, cycle = self.marginResults(cmat, n)
 
         if isHonest:
             self.__class__.extraEvents = dict()
@@ -826,10 +1076,11 @@ class Schulze(RankedMethod):
             cond3 = [c for c,v in condOrder[:3]]
             if condOrder==None:
                 condOrder = sorted(enumerate(result),key=lambda x:-x[1])
-            for b in ballots:
+            for b, w in zip(ballots, weights):
+                b = list(b)
                 b3 = [b[c] for c in cond3]
-                plurTally[b.index(max(b))] += 1
-                plur3Tally[b3.index(max(b3))] += 1
+                plurTally[b.index(max(b))] += w
+                plur3Tally[b3.index(max(b3))] += w
             plurOrder = sorted(enumerate(plurTally),key=lambda x:-x[1])
             plur3Order = sorted(enumerate(plur3Tally),key=lambda x:-x[1])
             if cycle:
@@ -872,72 +1123,74 @@ class Schulze(RankedMethod):
 
 class Rp(Schulze):
     def resolveCycle(self, cmat, n):
-        """Note: mutates cmat destructively.
+        """Number of candidates each one ends up locked in above, by Ranked Pairs.
+
+        Pairs are locked in from the largest margin down; pairs with equal
+        margins go in index order, and a zero margin counts as a win for the
+        lower index. reach[i, j] says whether i is locked above j, directly or
+        through other locks. Each lock ORs the outer product of "reaches i"
+        and "reached from j" into it, so it stays transitively closed and a
+        pair is skipped exactly when its loser already reaches its winner.
 
         >>> Rp().resultsFor(DeterministicModel(3)(5,3),Rp().honBallot,isHonest=True)["results"]
         [1, 2, 0]
+        >>> Rp().resolveCycle([[0,5,-3,1],[-5,0,7,-1],[3,-7,0,1],[-1,1,-1,0]], 4)
+        [3, 1, 0, 2]
         """
-        matches = [(i, j, cmat[i][j]) for i in range(n) for j in range(i,n) if i != j]
-        rps = sorted(matches,key=lambda x:-abs(x[2]))
-        for (i, j, margin) in rps:
-            if margin < 0:
-                i, j = j, i
-            if cmat[j][i] is True:
-                #print("rejecting",cmat)
-                pass #reject this victory
-            else: #lock-in
-                #print(i,j,cmat)
-                cmat[i][j] = True
-                #print("....",i,j,cmat)
-                for k in range(n):
-                    if k not in (i, j):
-                        if cmat[j][k] is True:
-                            cmat[i][k] = True
-                        if cmat[k][i] is True:
-                            cmat[k][j] = True
-
-                            #print(".......",i,j,k,cmat)
-
-        #print(cmat)
-        numWins = [sum(1 for j in range(n) if cmat[i][j] is True)
-                    for i in range(n)]
-        return numWins
+        cmat = np.asarray(cmat)
+        fronts, backs = np.triu_indices(n, 1)
+        margins = cmat[fronts, backs]
+        winners = np.where(margins < 0, backs, fronts)
+        losers = np.where(margins < 0, fronts, backs)
+        reach = np.zeros((n, n), dtype=bool)
+        for k in np.argsort(-abs(margins), kind="stable"):
+            i, j = winners[k], losers[k]
+            if reach[j, i] or reach[i, j]:
+                continue #would make a cycle, or is already implied
+            above = reach[:, i].copy()
+            above[i] = True
+            below = reach[j].copy()
+            below[j] = True
+            reach |= np.outer(above, below)
+        return reach.sum(axis=1).tolist()
 
 
 class IRNR(RankedMethod):
     stratMax = 10
 
     stratTargetFor = Method.stratTarget3 # strategize in favor of third place, because second place is pointless (can't change pairwise)
-    def results(self, ballots, **kwargs):
-        enabled = [True] * len(ballots[0])
-        numEnabled = sum(enabled)
+    tallyStat = None #IRNR reweights each ballot every round; results recounts
+    def results(self, ballots, *, weights=None, **kwargs):
+        """Instant Runoff Normalized Ratings: each round, every ballot is
+        scaled so its absolute ratings of the candidates still in the running
+        sum to 1, and the candidate with the lowest total drops out with that
+        total as its result. The last one standing keeps its final total.
+
+        Ballots rating every remaining candidate 0 can't be normalized; they
+        are spoiled, and count for no one that round.
+
+        >>> [round(r, 4) for r in IRNR().results([[3,2,0],[0,1,2],[0,2,1],[0,0,0]])]
+        [0.6, 2.0, 1.0]
+        >>> [round(r, 4) for r in IRNR().results([[3,2,0],[0,1,2],[0,0,0]], weights=[1,2,5])]
+        [0.6, 1.6667, 1.3333]
+        """
+        ballots = np.asarray(ballots, dtype=float)
+        if weights is None:
+            weights = np.ones(len(ballots))
+        weights = np.asarray(weights, dtype=float)
+        absBallots = abs(ballots)
+        enabled = np.ones(ballots.shape[1], dtype=bool)
         results = [None] * len(enabled)
-        while numEnabled > 1:
-            tsum = [0.0] * len(enabled)
-            for bal in ballots:
-                vsum = 0.0
-                for i, v in enumerate(bal):
-                    if enabled[i]:
-                        vsum += abs(v)
-                if vsum == 0.0:
-                    # TODO: count spoiled ballot
-                    continue
-                for i, v in enumerate(bal):
-                    if enabled[i]:
-                        tsum[i] += v / vsum
-            mini = None
-            minv = None
-            for i, v in enumerate(tsum):
-                if enabled[i]:
-                    if (minv is None) or (tsum[i] < minv):
-                        minv = tsum[i]
-                        mini = i
+        while enabled.sum() > 1:
+            vsums = absBallots @ enabled
+            counted = vsums != 0 #the rest are spoiled
+            scales = np.divide(weights, vsums, out=np.zeros_like(vsums), where=counted)
+            tsum = scales @ ballots
+            mini = np.flatnonzero(enabled)[np.argmin(tsum[enabled])]
             enabled[mini] = False
-            results[mini] = minv
-            numEnabled -= 1
-        for i, v in enumerate(tsum):
-            if enabled[i]:
-                results[i] = tsum[i]
+            results[mini] = tsum[mini].item()
+        for i in np.flatnonzero(enabled):
+            results[i] = tsum[i].item()
         return results
 
     @staticmethod #cls is provided explicitly, not through binding
@@ -2,6 +2,7 @@
 from mydecorators import autoassign, cached_property, setdefaultattr
 from voterModels import *
 import random
+import numpy as np
 from numpy.lib.scimath import sqrt
 from numpy.core.fromnumeric import mean, std
 from numpy.lib.function_base import median
@@ -37,6 +38,28 @@ class Chooser:
     def __call__(self, cls, voter, tally):
         return self.choice
 
+    def kinds(self, cls, voters, tally, which=None):
+        """The ballot kind this chooser picks for each of voters (an
+        ArrayElectorate whose ballots are stored), as an array. Tallies go to
+        tally, a TallyUpdates, and count only the voters in the boolean mask
+        which; by default, all of them. See allKinds.
+        """
+        return np.full(len(voters), self.choice, dtype=object)
+
+    def allKinds(self, cls, voters, tally):
+        """kinds for the whole electorate, adding its tallies to tally (a
+        SideTally) just as calling the chooser for each voter in turn would."""
+        updates = TallyUpdates()
+        kinds = self.kinds(cls, voters, updates)
+        updates.addTo(tally)
+        return kinds
+
+    def tallyCount(self):
+        """The most tally keys this chooser (with its subchoosers) can add to a
+        row; enough to size the output's tally columns."""
+        return len(self.tallyKeys) + sum(sub.tallyCount() for sub in self.subChoosers
+                                         if isinstance(sub, Chooser))
+
     def addTallyKeys(self, tally):
         for key in self.allTallyKeys:
             tally[key] = 0
@@ -57,6 +80,40 @@ class Chooser:
     def __name__(self):
         return self.__class__.__name__
 
+class TallyUpdates(list):
+    """Tallies from Chooser.kinds, held until they can be added to a SideTally
+    the way the voter-by-voter path would: a key only appears once some voter
+    touches it, and keys appear in the order voters first touch them, which
+    fixes the tally columns of the output.
+
+        >>> updates = TallyUpdates()
+        >>> updates.add("b", np.array([False, True]), 1)
+        >>> updates.add("a", np.array([False, False]), 0)
+        >>> updates.add("c", np.array([True, True]), 0)
+        >>> tally = SideTally()
+        >>> updates.addTo(tally)
+        >>> list(tally.items())
+        [('c', 0), ('b', 1)]
+    """
+    def add(self, key, counted, amount):
+        """Add amount to key, if any voter was counted for it."""
+        first = np.argmax(counted)
+        if counted[first]:
+            self.append((first, len(self), key, amount))
+
+    def addTo(self, tally):
+        for first, order, key, amount in sorted(self):
+            tally[key] += amount
+
+def chooserKinds(chooser, cls, voters, tally, which):
+    """Chooser.kinds, also for a bare kind name used as a subchooser."""
+    if callable(chooser):
+        return chooser.kinds(cls, voters, tally, which)
+    return np.full(len(voters), chooser, dtype=object)
+
+def everyone(which, nvot):
+    return np.ones(nvot, dtype=bool) if which is None else which
+
 beHon = Chooser("hon")
 beStrat = Chooser("strat")
 beX = Chooser("extraStrat")
@@ -71,13 +128,21 @@ class LazyChooser(Chooser):
 
 
     def __call__(self, cls, voter, tally):
-        if (getattr(voter, cls.__name__ + "_hon") ==
-            getattr(voter, cls.__name__ + "_strat")):
+        if np.array_equal(voter.storedBallot(cls, "hon"),
+                          voter.storedBallot(cls, "strat")):
             tally[self.myKeys[0]] += 0
             return self.subChoosers[0](cls, voter, tally) #hon
         tally[self.myKeys[0]] += 1
         return self.subChoosers[1](cls, voter, tally) #strat
 
+    def kinds(self, cls, voters, tally, which=None):
+        which = everyone(which, len(voters))
+        same = np.all(voters.ballots[cls, "hon"] == voters.ballots[cls, "strat"], axis=1)
+        tally.add(self.myKeys[0], which, int(np.count_nonzero(which & ~same)))
+        hon, x = self.subChoosers
+        return np.where(same, chooserKinds(hon, cls, voters, tally, which & same),
+                              chooserKinds(x, cls, voters, tally, which & ~same))
+
 class OssChooser(Chooser):
     tallyKeys = ["", "gap"]
     """one-sided strategy:
@@ -93,9 +158,9 @@ class OssChooser(Chooser):
 
     def __call__(self, cls, voter, tally):
         hon, strat = self.subChoosers
-        if getattr(voter, cls.__name__ + "_isStrat", False):
+        if voter.storedBallot(cls, "isStrat", False):
             tally[self.myKeys[0]] += 1
-            tally[self.myKeys[1]] += getattr(voter, cls.__name__ + "_stratGap", 0)
+            tally[self.myKeys[1]] += voter.storedBallot(cls, "stratGap", 0)
             if callable(strat):
                 #debug(strat)
                 return strat(cls, voter, tally)
@@ -106,6 +171,19 @@ class OssChooser(Chooser):
                 return hon(cls, voter, tally)
             return hon
 
+    def kinds(self, cls, voters, tally, which=None):
+        which = everyone(which, len(voters))
+        nvot = len(voters)
+        isStrat = voters.ballots.get((cls, "isStrat"), np.zeros(nvot, dtype=bool))
+        stratGap = voters.ballots.get((cls, "stratGap"), np.zeros(nvot))
+        goStrat = which & isStrat
+        tally.add(self.myKeys[0], goStrat, int(np.count_nonzero(goStrat)))
+        if goStrat.any(): #summed in voter order, as one voter at a time would
+            tally.add(self.myKeys[1], goStrat, np.cumsum(stratGap[goStrat])[-1].item())
+        hon, strat = self.subChoosers
+        return np.where(isStrat, chooserKinds(strat, cls, voters, tally, goStrat),
+                                 chooserKinds(hon, cls, voters, tally, which & ~isStrat))
+
     def getName(self):
         baseName = super(OssChooser, self).getName()
         return baseName + "." + "_".join(s.getName() for s in self.subChoosers) + "."
@@ -124,6 +202,38 @@ class ProbChooser(Chooser):
                     tally[self.getName() + "_" + chooser.getName()] += 1
                 return chooser(cls, voter, tally)
 
+    def kinds(self, cls, voters, tally, which=None):
+        """One multinomial draw for the whole electorate picks each voter's
+        subchooser.
+
+            >>> from methods import Score
+            >>> elec = ArrayElectorate(np.zeros((4000, 2)))
+            >>> for kind in ("hon", "strat"):
+            ...     for i in range(len(elec)):
+            ...         elec.ballots.put(Score, kind, i, [0, 0])
+            >>> tally = SideTally()
+            >>> kinds = ProbChooser([(1/4, beStrat), (3/4, beHon)]).allKinds(Score, elec, tally)
+            >>> sorted(set(kinds)), tally["Prob.strat25_hon75._hon"] == np.sum(kinds == "hon")
+            (['hon', 'strat'], True)
+            >>> 2800 < tally["Prob.strat25_hon75._hon"] < 3200
+            True
+        """
+        which = everyone(which, len(voters))
+        cumProbs = np.cumsum([p for (p, chooser) in self.probs])
+        picks = np.searchsorted(cumProbs, defaultRng().random(len(voters)), side="right")
+        picks = np.minimum(picks, len(self.probs) - 1)
+        result = np.empty(len(voters), dtype=object)
+        for (i, (p, chooser)) in enumerate(self.probs):
+            mine = picks == i
+            if i > 0: #keep tally for all but first option
+                tally.add(self.getName() + "_" + chooser.getName(), which & mine,
+                          int(np.count_nonzero(which & mine)))
+            result[mine] = chooserKinds(chooser, cls, voters, tally, which & mine)[mine]
+        return result
+
+    def tallyCount(self):
+        return len(self.probs) - 1 + super().tallyCount() #all but the first option
+
     def getName(self):
         baseName = super(ProbChooser, self).getName()
         return baseName + "." + "_".join(s.getName() + str(round(p * 100)) for p,s in self.probs) + "."
@@ -1,6 +1,7 @@
 from mydecorators import autoassign, cached_property, setdefaultattr
 
 import random
+import numpy as np
 from numpy.lib.scimath import sqrt
 from numpy.core.fromnumeric import mean, std
 from numpy.lib.function_base import median
@@ -9,6 +10,12 @@ from scipy.stats import beta
 from test.test_binop import isnum
 from debugDump import *
 
+def defaultRng():
+    """A NumPy Generator seeded from the global `random` state, so that
+    `random.seed` keeps making whole runs reproducible.
+    """
+    return np.random.default_rng(random.getrandbits(64))
+
 class Voter(tuple):
     """A tuple of candidate utilities.
 
@@ -68,6 +75,39 @@ class Voter(tuple):
         This version is a stub, since this voter class has no attrs."""
         return self.__class__(utils)
 
+    @property
+    def prefOrder(self):
+        """Candidate indexes from most to least preferred (ties in index order).
+
+        A row of an ArrayElectorate reads this from its electorate's ranking,
+        which is sorted once for all voters.
+            >>> Voter([5,7,6]).prefOrder
+            [1, 2, 0]
+        """
+        try:
+            return self.elec.prefOrders[self.rowIndex].tolist()
+        except AttributeError:
+            return rankingOf([self])[0].tolist()
+
+    def storedBallot(self, cls, kind, *default):
+        """This voter's row of the (cls, kind) entry in its electorate's
+        BallotStore; or default, if one is given and there is no such entry."""
+        try:
+            return self.elec.ballots[cls, kind][self.rowIndex]
+        except (AttributeError, KeyError):
+            if default:
+                return default[0]
+            raise
+
+    @classmethod
+    def fromRow(cls, utils, personality, cluster):
+        """Create a voter from one row of an ArrayElectorate, without
+        drawing a new personality or cluster."""
+        voter = tuple.__new__(cls, utils)
+        voter.personality = personality
+        voter.cluster = cluster
+        return voter
+
     def mutantChild(self, muteWeight):
         """Returns a copy hybridized with a random voter of weight muteWeight.
 
@@ -104,6 +144,13 @@ class PersonalityVoter(Voter):
     def resetClusters(cls):
         cls.cluster_count = 0
 
+    @classmethod
+    def newClusters(cls, n):
+        """Reserve n fresh cluster ids at once; returns them as an array."""
+        first = cls.cluster_count
+        cls.cluster_count += n
+        return np.arange(first, first + n)
+
     def copyWithUtils(self, utils):
         voter = super().copyWithUtils(utils)
         voter.copyAttrsFrom(self)
@@ -126,6 +173,257 @@ class Electorate(list):
         """
         return list(map(mean,zip(*self)))
 
+class BallotStore(dict):
+    """The ballots of one electorate, keyed by (method class, kind), where
+    kind is what choosers return: "hon", "strat", "isStrat" and so on.
+
+    Each entry has a row per voter: an (nvot, ncand) float array of ballots,
+    or an (nvot,) vector of a per-voter value such as isStrat or stratGap.
+    `built` keeps the whole-electorate output of ballot builders, keyed by
+    (method class, kind and its parameters); see electorateBallots.
+    `lazy` holds declared entries that nothing has asked for yet: asking for
+    one builds it for the whole electorate (see declare).
+    `margins` caches the pairwiseMargins of ballot sets tallied in this
+    election; see methods.pairwiseMargins.
+    Method.multiResults forgets a method's entries once its election is done.
+
+        >>> store = BallotStore(2)
+        >>> store.put(Voter, "hon", 1, [3, 4])
+        >>> store.put(Voter, "isStrat", 1, True)
+        >>> store[Voter, "hon"][1], store[Voter, "isStrat"].tolist()
+        (array([3., 4.]), [False, True])
+        >>> store.forget(Voter)
+        >>> len(store)
+        0
+    """
+    def __init__(self, nvot):
+        super().__init__()
+        self.nvot = nvot
+        self.built = dict()
+        self.lazy = dict()
+        self.variants = dict()
+        self.margins = dict()
+
+    def declare(self, cls, kind, variant, voters):
+        """Promise a (cls, kind) entry, to be filled by variant(cls, voter) for
+        each of voters the first time it is asked for. Declaring it again with
+        the same variant does nothing; with another (eg a strategic ballot's
+        variant for new polls), it drops what the old one built.
+
+            >>> store = BallotStore(2)
+            >>> calls = []
+            >>> def double(cls, voter):
+            ...     calls.append(voter.rowIndex)
+            ...     return [2 * u for u in voter]
+            >>> store.declare(Voter, "extra", double, ArrayElectorate([[1, 2], [3, 4]]))
+            >>> calls, (Voter, "extra") in store
+            ([], False)
+            >>> store[Voter, "extra"].tolist(), store.get((Voter, "extra")) is store[Voter, "extra"]
+            ([[2.0, 4.0], [6.0, 8.0]], True)
+            >>> calls
+            [0, 1]
+            >>> store.declare(Voter, "extra", double, None)
+            >>> store[Voter, "extra"].tolist(), calls
+            ([[2.0, 4.0], [6.0, 8.0]], [0, 1])
+            >>> store.declare(Voter, "extra", lambda cls, voter: list(voter),
+            ...               ArrayElectorate([[1, 2], [3, 4]]))
+            >>> store[Voter, "extra"].tolist()
+            [[1.0, 2.0], [3.0, 4.0]]
+        """
+        if self.variants.get((cls, kind)) is variant:
+            return
+        self.pop((cls, kind), None)
+        self.variants[cls, kind] = variant
+        self.lazy[cls, kind] = (variant, voters)
+
+    def __missing__(self, key):
+        variant, voters = self.lazy.pop(key) #KeyError if never declared
+        cls, kind = key
+        for voter in voters:
+            self.put(cls, kind, voter.rowIndex, variant(cls, voter))
+        return self[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def put(self, cls, kind, i, value):
+        """Store voter i's value for (cls, kind)."""
+        try:
+            entry = self[cls, kind]
+        except KeyError:
+            shape = np.shape(value)
+            dtype = bool if isinstance(value, (bool, np.bool_)) else float
+            entry = self[cls, kind] = np.zeros((self.nvot,) + shape, dtype=dtype)
+        entry[i] = value
+
+    def putAll(self, cls, kind, values):
+        """Store every voter's value for (cls, kind) at once, as put would
+        have stored them one by one.
+
+            >>> store = BallotStore(2)
+            >>> store.putAll(Voter, "hon", np.array([[1, 2], [3, 4]]))
+            >>> store.putAll(Voter, "isStrat", np.array([True, False]))
+            >>> store[Voter, "hon"].dtype, store[Voter, "isStrat"].dtype
+            (dtype('float64'), dtype('bool'))
+        """
+        values = np.asarray(values)
+        self[cls, kind] = values.astype(bool if values.dtype == bool else float)
+
+    def pick(self, cls, kinds, rows=None):
+        """Each voter's row of the (cls, kind) entry for their kind in kinds;
+        or if rows (voter indices) is given, kinds are for just those voters.
+
+            >>> store = BallotStore(3)
+            >>> for i in range(3):
+            ...     store.put(Voter, "hon", i, [i, i])
+            ...     store.put(Voter, "strat", i, [-i, -i])
+            >>> store.pick(Voter, np.array(["hon", "strat", "hon"])).tolist()
+            [[0.0, 0.0], [-1.0, -1.0], [2.0, 2.0]]
+            >>> store.pick(Voter, np.array(["strat"]), [2]).tolist()
+            [[-2.0, -2.0]]
+        """
+        ballots = None
+        for kind in set(np.asarray(kinds).tolist()):
+            entry = self[cls, kind] if rows is None else self[cls, kind][rows]
+            if ballots is None:
+                ballots = np.empty_like(entry)
+            mine = kinds == kind
+            ballots[mine] = entry[mine]
+        return ballots
+
+    def forget(self, cls):
+        """Free everything stored for method class cls."""
+        for entries in (self, self.built, self.lazy, self.variants):
+            for key in [key for key in entries if key[0] is cls]:
+                del entries[key]
+
+class ArrayElectorate:
+    """An electorate stored as one (nvot, ncand) utility matrix, plus parallel
+    arrays for each voter's personality and cluster.
+
+    Iterating or indexing gives row views: voters of type vType (a Voter tuple
+    subclass) which know their electorate (`elec`) and row (`rowIndex`). They are
+    only built when first asked for, so code that works on `utils` directly never
+    pays for per-voter objects.
+
+        >>> e = ArrayElectorate([[1,2],[3,4]], personality=[0,0], cluster=[5,6])
+        >>> e.utils.shape
+        (2, 2)
+        >>> e
+        [(1, 2), (3, 4)]
+        >>> e.socUtils
+        [2.0, 3.0]
+        >>> e[1].rowIndex, e[1].elec is e, e[1].cluster, e[1].index(4)
+        (1, True, 6, 1)
+        >>> [len(v) for v in e]
+        [2, 2]
+    """
+    def __init__(self, utils, vType=PersonalityVoter, personality=None,
+                 cluster=None, rng=None):
+        self.utils = np.asarray(utils)
+        self.vType = vType
+        nvot = len(self.utils)
+        if personality is None:
+            if rng is None:
+                rng = defaultRng()
+            personality = rng.standard_normal(nvot)
+        self.personality = np.asarray(personality)
+        if cluster is None:
+            cluster = (vType.newClusters(nvot) if hasattr(vType, "newClusters")
+                       else np.arange(nvot))
+        self.cluster = np.asarray(cluster)
+
+    @classmethod
+    def fromVoters(cls, voters, vType=None):
+        """Pack a list of voter tuples (keeping any personality and cluster).
+
+            >>> ArrayElectorate.fromVoters(Electorate([Voter([1,2]),Voter([3,4])])).utils
+            array([[1, 2],
+                   [3, 4]])
+        """
+        if isinstance(voters, cls):
+            return voters
+        voters = list(voters)
+        if vType is None:
+            vType = type(voters[0]) if voters and isinstance(voters[0], Voter) else PersonalityVoter
+        return cls([tuple(v) for v in voters], vType,
+                   personality=[getattr(v, "personality", 0.) for v in voters],
+                   cluster=[getattr(v, "cluster", i) for i, v in enumerate(voters)])
+
+    def copyWithUtils(self, utils):
+        """A new electorate with the same voters (personality, cluster) but new utils."""
+        return self.__class__(utils, self.vType, self.personality, self.cluster)
+
+    @property
+    def ncand(self):
+        return self.utils.shape[1]
+
+    @cached_property
+    def socUtils(self):
+        """Mean utility across electorate for each candidate."""
+        return self.utils.mean(axis=0).tolist()
+
+    @cached_property
+    def ballots(self):
+        """The BallotStore for ballots cast by this electorate."""
+        return BallotStore(len(self.utils))
+
+    @cached_property
+    def prefOrders(self):
+        """Each voter's candidates from most to least preferred (ties in index
+        order), as an (nvot, ncand) array. Sorted once and shared by every
+        ranked method's ballots.
+
+            >>> ArrayElectorate([[1,3,2],[2,2,1]], personality=[0,0], cluster=[0,1]).prefOrders
+            array([[1, 2, 0],
+                   [0, 1, 2]])
+        """
+        return np.argsort(-self.utils, axis=1, kind="stable")
+
+    def row(self, i):
+        voter = self.vType.fromRow(self.utils[i].tolist(),
+                                   self.personality[i].item(), self.cluster[i].item())
+        voter.elec = self
+        voter.rowIndex = i
+        return voter
+
+    @cached_property
+    def rows(self):
+        """Row views, built once so that anything attached to them sticks."""
+        return [self.row(i) for i in range(len(self.utils))]
+
+    def __len__(self):
+        return len(self.utils)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, i):
+        return self.rows[i]
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.utils
+        return self.utils.astype(dtype)
+
+    def __repr__(self):
+        return repr(self.rows)
+
+def asElectorate(voters):
+    """Return voters as an ArrayElectorate, converting a list of voters if needed."""
+    return ArrayElectorate.fromVoters(voters)
+
+def rankingOf(voters):
+    """The prefOrders of voters: an ArrayElectorate's cached ones, or sorted
+    now for any other (nvot, ncand) array-like."""
+    try:
+        return voters.prefOrders
+    except AttributeError:
+        return np.argsort(-np.asarray(voters, dtype=float), axis=1, kind="stable")
+
 
 class RandomModel:
     """Empty base class for election models; that is, electorate factories.
@@ -133,12 +431,63 @@ class RandomModel:
     >>> e4 = RandomModel()(4,3)
     >>> [len(v) for v in e4]
     [3, 3, 3, 3]
+
+    Models that can draw many electorates in one vectorized call say so with
+    canBatch; batch() then returns a (nelections, nvot, ncand) utility tensor.
+    >>> RandomModel().batch(5, 4, 3).shape
+    (5, 4, 3)
+    >>> [len(e) for e in RandomModel().electorates(3, 4, 2, budget=16)]
+    [4, 4, 4]
+
+    electorates draws as many electorates at a time as fit in a budget of
+    utilities, so a chunk takes about the same memory whatever nvot and ncand:
+    >>> class Counted(RandomModel):
+    ...     def batch(self, nelections, nvot, ncand, rng=None):
+    ...         sizes.append(nelections)
+    ...         return super().batch(nelections, nvot, ncand, rng)
+    >>> sizes = []
+    >>> len(list(Counted().electorates(5, 4, 2, budget=16))), sizes
+    (5, [2, 2, 1])
     """
 
+    canBatch = True
+
     def __str__(self):
         return self.__class__.__name__
-    def __call__(self, nvot, ncand, vType=PersonalityVoter):
-        return Electorate(vType.rand(ncand) for i in range(nvot))
+    def __call__(self, nvot, ncand, vType=PersonalityVoter, rng=None):
+        if rng is None:
+            rng = defaultRng()
+        return self.electorateFrom(self.batch(1, nvot, ncand, rng)[0], vType, rng)
+
+    def batch(self, nelections, nvot, ncand, rng=None):
+        """Utilities for nelections electorates at once: independent standard normals."""
+        if rng is None:
+            rng = defaultRng()
+        return rng.standard_normal((nelections, nvot, ncand))
+
+    def stackCalls(self, nelections, nvot, ncand, rng=None):
+        """batch() for models which can only build one electorate at a time."""
+        return np.array([np.asarray(self(nvot, ncand, rng=rng))
+                         for i in range(nelections)])
+
+    def electorateFrom(self, utils, vType=PersonalityVoter, rng=None):
+        """Wrap one (nvot, ncand) slice of batch() as an electorate."""
+        return ArrayElectorate(utils, vType, rng=rng)
+
+    def electorates(self, niter, nvot, ncand, rng=None, budget=10**6):
+        """Generate niter electorates, drawing their utilities a chunk at a time
+        if the model can batch; a chunk holds at most budget utilities (but
+        always at least one electorate)."""
+        if rng is None:
+            rng = defaultRng()
+        if not self.canBatch:
+            for i in range(niter):
+                yield self(nvot, ncand, rng=rng)
+            return
+        chunk = max(1, budget // (nvot * ncand))
+        for start in range(0, niter, chunk):
+            for utils in self.batch(min(chunk, niter - start), nvot, ncand, rng):
+                yield self.electorateFrom(utils, rng=rng)
 
 class DeterministicModel(RandomModel):
     """Basically, a somewhat non-boring stub for testing.
@@ -151,9 +500,9 @@ class DeterministicModel(RandomModel):
     def __init__(self, modulo):
         pass
 
-    def __call__(self, nvot, ncand, vType=PersonalityVoter):
-        return Electorate(vType((i+j)%self.modulo for i in range(ncand))
-                          for j in range(nvot))
+    def batch(self, nelections, nvot, ncand, rng=None):
+        utils = (np.arange(ncand)[None, :] + np.arange(nvot)[:, None]) % self.modulo
+        return np.tile(utils, (nelections, 1, 1))
 
 class ReverseModel(RandomModel):
     """Creates an even number of voters in two diametrically-opposed camps
@@ -164,14 +513,29 @@ class ReverseModel(RandomModel):
     [3, 3, 3, 3]
     >>> e4[0].hybridWith(e4[3],1)
     (0.0, 0.0, 0.0)
+    >>> abs(ReverseModel().batch(2, 4, 3).sum(axis=1)).max()
+    0.0
     """
-    def __call__(self, nvot, ncand, vType=PersonalityVoter):
+    def batch(self, nelections, nvot, ncand, rng=None):
         if nvot % 2:
             raise ValueError
-        basevoter = vType.rand(ncand)
-        return Electorate( ([basevoter] * (nvot//2)) +
-                           ([vType(-q for q in basevoter)] * (nvot//2))
-                        )
+        if rng is None:
+            rng = defaultRng()
+        basevoters = rng.standard_normal((nelections, 1, ncand))
+        return np.where(self.camps(nvot)[None, :, None], -basevoters, basevoters)
+
+    @staticmethod
+    def camps(nvot):
+        return (np.arange(nvot) >= nvot // 2).astype(int)
+
+    def electorateFrom(self, utils, vType=PersonalityVoter, rng=None):
+        #each camp is one voter, repeated
+        if rng is None:
+            rng = defaultRng()
+        camps = self.camps(len(utils))
+        return ArrayElectorate(utils, vType,
+                               personality=rng.standard_normal(2)[camps],
+                               cluster=vType.newClusters(2)[camps])
 
 class QModel(RandomModel):
     """Adds a quality dimension to a base model,
@@ -191,15 +555,39 @@ class QModel(RandomModel):
         >>> 0.4 < std(list(zip(e4))) < 0.6
         True
 
+    Batches the same way
+        >>> 0.4 < std(QModel(sqrt(3), RandomModel()).batch(10, 100, 1), axis=1).mean() < 0.6
+        True
     """
     @autoassign
     def __init__(self, qWeight=0.5, baseModel=ReverseModel()):
         pass
 
-    def __call__(self, nvot, ncand, vType=PersonalityVoter):
-        qualities = vType.rand(ncand)
-        return Electorate([v.hybridWith(qualities,self.qWeight)
-                for v in self.baseModel(nvot, ncand, vType)])
+    @property
+    def canBatch(self):
+        return self.baseModel.canBatch
+
+    def __call__(self, nvot, ncand, vType=PersonalityVoter, rng=None):
+        if rng is None:
+            rng = defaultRng()
+        qualities = rng.standard_normal(ncand)
+        base = asElectorate(self.baseModel(nvot, ncand, vType, rng=rng))
+        return base.copyWithUtils(self.hybridize(base.utils, qualities))
+
+    def hybridize(self, utils, qualities):
+        return (utils + self.qWeight * qualities) / sqrt(1 + self.qWeight ** 2)
+
+    def batch(self, nelections, nvot, ncand, rng=None):
+        if rng is None:
+            rng = defaultRng()
+        if not self.canBatch:
+            return self.stackCalls(nelections, nvot, ncand, rng)
+        qualities = rng.standard_normal((nelections, 1, ncand))
+        return self.hybridize(self.baseModel.batch(nelections, nvot, ncand, rng),
+                              qualities)
+
+    def electorateFrom(self, utils, vType=PersonalityVoter, rng=None):
+        return self.baseModel.electorateFrom(utils, vType, rng)
 
 class PolyaModel(RandomModel):
     """This creates electorates based on a Polya/Hoppe/Dirichlet model, with mutation.
@@ -213,51 +601,130 @@ class PolyaModel(RandomModel):
                  mutantFactor=0.2):
         pass
 
-    def __call__(self, nvot, ncand, vType=PersonalityVoter):
+    canBatch = False
+    batch = RandomModel.stackCalls
+
+    def __call__(self, nvot, ncand, vType=PersonalityVoter, rng=None):
         """Tests? Making statistical tests that would pass reliably is
         a huge hassle. Sorry, maybe later.
+
+        The urn draws and mutation noise for the whole electorate are drawn up
+        front. Each mutant is a*parent + b*noise, so following the chains of
+        parents back to a seed or wildcard voter by pointer jumping gives
+        everybody's utilities (and cluster) in log(depth) array steps.
+
+        Mutants share their ancestor's cluster:
+            >>> e = PolyaModel()(1000, 3)
+            >>> len(e), len(set(e.cluster.tolist())) < 100
+            (1000, True)
         """
         vType.resetClusters()
-        election = self.seedModel(self.seedVoters, ncand, vType)
-        while len(election) < nvot:
-            i = random.randrange(len(election) + self.alpha)
-            if i < len(election):
-                election.append(election[i].mutantChild(self.mutantFactor))
-            else:
-                election.append(vType.rand(ncand))
-        return election
+        if rng is None:
+            rng = defaultRng()
+        seed = asElectorate(self.seedModel(self.seedVoters, ncand, vType, rng=rng))
+        nseed = len(seed)
+        if nvot <= nseed:
+            return seed
+        sizes = np.arange(nseed, nvot) #size of the urn at each draw
+        draws = rng.random(nvot - nseed) * (sizes + self.alpha)
+        isWild = draws >= sizes
+        isRoot = np.concatenate([np.ones(nseed, dtype=bool), isWild])
+        noise = rng.standard_normal((nvot - nseed, ncand))
+        scale = sqrt(1 + self.mutantFactor ** 2)
+
+        #invariant: utils[k] == acc[k] + mult[k] * utils[ptr[k]]
+        ptr = np.arange(nvot)
+        ptr[nseed:] = np.where(isWild, ptr[nseed:], draws.astype(int))
+        mult = np.where(isRoot, 0., 1 / scale)
+        acc = np.empty((nvot, ncand))
+        acc[:nseed] = seed.utils
+        acc[nseed:] = np.where(isWild[:, None], noise, noise * self.mutantFactor / scale)
+        while True:
+            acc += mult[:, None] * acc[ptr]
+            if isRoot[ptr].all():
+                break
+            mult = mult * mult[ptr]
+            ptr = ptr[ptr]
+
+        wild = np.flatnonzero(isRoot[nseed:]) + nseed
+        personality = np.empty(nvot)
+        personality[:nseed] = seed.personality
+        personality[wild] = rng.standard_normal(len(wild))
+        cluster = np.empty(nvot, dtype=int)
+        cluster[:nseed] = seed.cluster
+        cluster[wild] = vType.newClusters(len(wild))
+        return ArrayElectorate(acc, vType, personality[ptr], cluster[ptr])
 
 class DimVoter(PersonalityVoter):
     """A voter in an n-dimensional model.
 
-
+    One made on its own with fromDims isn't a row of any electorate, so its
+    ballots are worked out just for it:
+        >>> from methods import Mav
+        >>> e = DimModel(2, baseElectorate=DeterministicModel(3))(2, 4)
+        >>> v = DimVoter.fromDims(DeterministicModel(3)(1, 2)[0], e)
+        >>> v.dims, Mav().honBallot(Mav, v)
+        ((0, 1), [0, 4, 0, 0])
      """
 
     @classmethod
     def fromDims(cls, v, e, caring = None):
-        if caring==None:
-            caring = [1] * len(v)
-            totCaring = e.totWeight
-        else:
-            totCaring = sum((c*w)**2 for c,w in zip(caring, e.dimWeights))
-        me = cls(-sqrt(
-            sum(((vd - cd)*w*cares)**2 for (vd, cd, w, cares) in zip(v,c,e.dimWeights,caring)) /
-                            totCaring)
-          for c in e.cands)
+        utils = DimElectorate.distanceUtils([v], e.cands, e.dimWeights,
+                                            None if caring is None else [caring])
+        me = cls(utils[0].tolist())
         me.copyAttrsFrom(v)
         me.dims = v
-        me.elec = e
         return me
 
 
-class DimElectorate(Electorate):
+class DimElectorate(ArrayElectorate):
+    """An electorate whose utilities come from distances to candidates in a
+    space with weighted dimensions. Created empty; DimModel.makeElectorate
+    places the voters and candidates and then fills in the utility matrix.
+    """
+
+    def __init__(self, *args, **kw):
+        if args:
+            super().__init__(*args, **kw)
+
+    @staticmethod
+    def distanceUtils(voterDims, candDims, dimWeights, caring=None):
+        """Utilities of every voter for every candidate, all at once: minus the
+        distance between them, with each dimension weighted by dimWeights (times
+        the voter's caring for it, if given) and normalized by the total weight.
+
+            >>> DimElectorate.distanceUtils([[0,0],[3,0]], [[0,0],[3,4]], [1,1])
+            array([[-0.        , -3.53553391],
+                   [-2.12132034, -2.82842712]])
+            >>> DimElectorate.distanceUtils([[0,0]], [[3,4]], [1,1], caring=[[1,0]])
+            array([[-3.]])
+        """
+        weights = np.asarray(dimWeights, dtype=float)[None, :]
+        if caring is not None:
+            weights = weights * np.asarray(caring, dtype=float)
+        totCaring = (weights ** 2).sum(axis=1)
+        diffs = ((np.asarray(voterDims, dtype=float)[:, None, :] -
+                  np.asarray(candDims, dtype=float)[None, :, :]) * weights[:, None, :])
+        return -np.sqrt((diffs ** 2).sum(axis=2) / totCaring[:, None])
 
     def asDims(self, v, *args):
         return v
 
-    def fromDims(self, dimvoters, vType):
-        for v in dimvoters:
-            self.append(vType.fromDims(v,self))
+    def allAsDims(self, dims):
+        """Positions (and caring, or None for "cares equally") for every row of
+        dims, a matrix of base-model draws."""
+        return np.asarray(dims, dtype=float), None
+
+    def fromDims(self, dims, vType, caring=None, personality=None, cluster=None):
+        self.dims = np.asarray(dims, dtype=float)
+        self.caring = caring
+        super().__init__(self.distanceUtils(self.dims, self.cands, self.dimWeights, caring),
+                         vType, personality, cluster)
+
+    def row(self, i):
+        voter = super().row(i)
+        voter.dims = tuple(self.dims[i].tolist())
+        return voter
 
     def calcTotWeight(self):
         self.totWeight = sum([w**2 for w in self.dimWeights])
@@ -267,13 +734,15 @@ class DimModel(RandomModel):
 
     >>> dm = DimModel(2,baseElectorate=DeterministicModel(3))
     >>> dm(2,4)
-    [(4.25, 0.0, 1.25, 4.25), (2.0, 1.25, 0.0, 2.0)]
+    [(-1.8439088914585775, -0.0, -1.0, -1.8439088914585775), (-1.2649110640673518, -1.0, -0.0, -1.2649110640673518)]
     >>> dm.dimWeights
     [1, 0.5]
 
 
     """
     builtElectorate = DimElectorate
+    canBatch = False
+    batch = RandomModel.stackCalls
 
     @autoassign
     def __init__(self, ndims=3, dimWeights=None, baseElectorate=RandomModel()):
@@ -281,17 +750,20 @@ class DimModel(RandomModel):
             self.dimWeights = [2**(-n) for n in range(ndims)]
         assert(len(self.dimWeights) == self.ndims)
 
-    def __call__(self, nvot, ncand, vType=DimVoter):
+    def __call__(self, nvot, ncand, vType=DimVoter, rng=None):
         elec = self.builtElectorate()
         elec.dimWeights = self.dimWeights
-        return self.makeElectorate(elec, nvot, ncand, vType)
+        return self.makeElectorate(elec, nvot, ncand, vType, rng)
 
-    def makeElectorate(self, elec, nvot, ncand, vType):
+    def makeElectorate(self, elec, nvot, ncand, vType, rng=None):
         elec.calcTotWeight()
-        votersncands = self.baseElectorate(nvot + ncand, len(elec.dimWeights), vType)
-        elec.base = [elec.asDims(v,i) for i,v in enumerate(votersncands[:nvot])]
-        elec.cands = [elec.asDims(v,nvot+i) for i,v in enumerate(votersncands[nvot:])]
-        elec.fromDims(elec.base, vType)
+        votersncands = asElectorate(self.baseElectorate(nvot + ncand, len(elec.dimWeights),
+                                                        vType, rng=rng))
+        dims, caring = elec.allAsDims(votersncands.utils)
+        elec.base = dims[:nvot]
+        elec.cands = dims[nvot:]
+        elec.fromDims(elec.base, vType, None if caring is None else caring[:nvot],
+                      votersncands.personality[:nvot], votersncands.cluster[:nvot])
         return elec
 
 def rbeta(a,b):
@@ -301,32 +773,68 @@ unishdist = rbeta(1,.8)
 
 caresDist = rbeta(3,1.5)
 
+def decayingWeights(start, cut, decay, rng):
+    """The weights start, start*b1, start*b1*b2, ... which are above cut, where
+    the b's are independent Beta(*decay) draws (taken from rng a block at a time).
+
+        >>> ws = decayingWeights(1, .2, (1, 1), np.random.default_rng(0))
+        >>> ws[0], min(ws) > .2, ws == sorted(ws, reverse=True)
+        (1.0, True, True)
+        >>> decayingWeights(.1, .2, (1, 1), np.random.default_rng(0))
+        []
+    """
+    weights = np.array([float(start)])
+    while weights[-1] > cut:
+        weights = np.concatenate([weights,
+                                  weights[-1] * np.cumprod(rng.beta(*decay, size=8))])
+    return weights[:np.argmax(weights <= cut)].tolist()
+
 class KSElectorate(DimElectorate):
 
-    def chooseClusters(self, n, alpha, caring):
-        self.clusters = []
-        for i in range(n):
-            item = []
-            for c in range(self.numClusters):
-                r = (i+alpha) * random.random()
-                if r > i:
-                    item.append(self.numSubclusters[c])
-                    self.numSubclusters[c] += 1
-                else:
-                    item.append(self.clusters[int(r)][c])
-            self.clusters.append(item)
+    def chooseClusters(self, n, alpha, caring, rng=None):
+        """Assign n voters (and candidates) to subclusters of each dimensional
+        cluster by a Chinese restaurant process, and draw each subcluster's mean
+        and caring from Beta(*caring).
+
+        Voter i starts a new subcluster with probability alpha/(i+alpha), and
+        otherwise joins a uniformly-chosen earlier voter's. All voters and
+        clusters are drawn at once; following each voter's chain of "joined"
+        links back to the voter who started the subcluster is done by pointer
+        jumping, so it takes log(n) array steps rather than a loop over voters.
+
+            >>> e = KSElectorate()
+            >>> e.numClusters, e.dcs = 2, [1, 2]
+            >>> e.chooseClusters(50, 1, (3, 1.5))
+            >>> e.clusters.shape, e.clusters[0].tolist()
+            ((50, 2), [0, 0])
+            >>> [m.shape[0] for m in e.clusterMeans] == e.numSubclusters.tolist()
+            True
+            >>> (e.clusters.max(axis=0) + 1 == e.numSubclusters).all()
+            True
+        """
+        if rng is None:
+            rng = defaultRng()
+        i = np.arange(n)[:, None]
+        r = (i + alpha) * rng.random((n, self.numClusters))
+        isNew = r >= i
+        root = np.where(isNew, i, r.astype(int))
+        cols = np.arange(self.numClusters)
+        while True:
+            nextRoot = root[root, cols]
+            if (nextRoot == root).all():
+                break
+            root = nextRoot
+        #subclusters are numbered in order of appearance
+        self.clusters = (np.cumsum(isNew, axis=0) - 1)[root, cols]
+        self.numSubclusters = isNew.sum(axis=0)
         self.clusterMeans = []
         self.clusterCaring = []
         for c in range(self.numClusters):
-            subclusterMeans = []
-            subclusterCaring = []
-            for i in range(self.numSubclusters[c]):
-                cares = caring()
-
-                subclusterMeans.append([random.gauss(0,sqrt(cares)) for i in range(self.dcs[c])])
-                subclusterCaring.append(caring())
-            self.clusterMeans.append(subclusterMeans)
-            self.clusterCaring.append(subclusterCaring)
+            nsub = self.numSubclusters[c]
+            cares = rng.beta(*caring, size=nsub)
+            self.clusterMeans.append(rng.standard_normal((nsub, self.dcs[c])) *
+                                     np.sqrt(cares)[:, None])
+            self.clusterCaring.append(rng.beta(*caring, size=nsub))
 
     def asDims(self, v, i):
         result = []
@@ -343,9 +851,20 @@ class KSElectorate(DimElectorate):
         v.cares = cares
         return v
 
-    def fromDims(self, dimvoters, vType):
-        for v in dimvoters:
-            self.append(vType.fromDims(v,self,v.cares))
+    def allAsDims(self, dims):
+        """Vectorized asDims for every row of dims at once."""
+        positions = np.empty((len(dims), sum(self.dcs)))
+        cares = np.empty_like(positions)
+        start = 0
+        for c, width in enumerate(self.dcs):
+            sub = self.clusters[:, c]
+            acare = self.clusterCaring[c][sub]
+            #as in asDims, all the dimensions of a cluster share the draw dims[:, c]
+            positions[:, start:start + width] = (self.clusterMeans[c][sub] +
+                                    (dims[:, c] * np.sqrt(1 - acare))[:, None])
+            cares[:, start:start + width] = acare[:, None]
+            start += width
+        return positions, cares
 
 class KSModel(DimModel): #Kitchen sink
 
@@ -362,25 +881,20 @@ class KSModel(DimModel): #Kitchen sink
     def __str__(self):
         return "_".join(str(x) for x in (self.__class__.__name__,self.wcalpha) + self.dcdecay + self.wcdecay + self.vccaring)
 
-    def __call__(self, nvot, ncand, vType=DimVoter):
+    def __call__(self, nvot, ncand, vType=DimVoter, rng=None):
         """Tests? Making statistical tests that would pass reliably is
         a huge hassle. Sorry, maybe later.
         """
         vType.resetClusters()
+        if rng is None:
+            rng = defaultRng()
         e = self.builtElectorate()
         e.dcs = [] #number of dimensions in each dc
         e.dimWeights = [] #raw importance of each dimension, regardless of dc
-        clusterWeight = 1
-        while clusterWeight > self.dccut:
-            dimweight = clusterWeight
-            dimnum = 0
-            while dimweight > self.wccut:
-                e.dimWeights.append(dimweight)
-                dimnum += 1
-                dimweight *= beta.rvs(*self.wcdecay)
-            e.dcs.append(dimnum)
-            clusterWeight *= beta.rvs(*self.dcdecay)
+        for clusterWeight in decayingWeights(1, self.dccut, self.dcdecay, rng):
+            dimWeights = decayingWeights(clusterWeight, self.wccut, self.wcdecay, rng)
+            e.dimWeights.extend(dimWeights)
+            e.dcs.append(len(dimWeights))
         e.numClusters = len(e.dcs)
-        e.numSubclusters = [0] * e.numClusters
-        e.chooseClusters(nvot + ncand, self.wcalpha, lambda:beta.rvs(*self.vccaring))
-        return self.makeElectorate(e, nvot, ncand, vType)
+        e.chooseClusters(nvot + ncand, self.wcalpha, self.vccaring, rng)
+        return self.makeElectorate(e, nvot, ncand, vType, rng)
@@ -14,8 +14,12 @@ from debugDump import *
 from voterModels import *
 from stratFunctions import *
 from methods import *
-from uuid import uuid4
-import csv, os
+from uuid import uuid4, UUID
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+from array import array
+import csv, os, hashlib, json, numbers, zipfile
 join = os.path.join
 
 
@@ -29,11 +33,218 @@ def uniquify(seq):
            checked.append(e)
     return checked
 
+def electionRng(seed, i):
+    """Seed `random`, and return a NumPy Generator, for election i of a batch.
+
+    Both streams depend only on (seed, i), so an election comes out the same
+    whichever process runs it, and in whatever order.
+
+        >>> r1 = electionRng("x", 3).random(); a = random.random()
+        >>> r2 = electionRng("x", 3).random(); b = random.random()
+        >>> (r1, a) == (r2, b), r1 == electionRng("x", 4).random()
+        (True, False)
+    """
+    entropy = int.from_bytes(hashlib.sha256(str(seed).encode()).digest()[:16], "big")
+    pySeq, npSeq = np.random.SeedSequence(entropy, spawn_key=(i,)).spawn(2)
+    random.seed(int(pySeq.generate_state(1, np.uint64)[0]))
+    return np.random.default_rng(npSeq)
+
+_workerBatch = None #the CsvBatch whose elections a (forked) worker process runs
+
+def _runShard(bounds):
+    """Rows for a shard, and the results cache hits and misses they took."""
+    resultsCacheTally.clear()
+    rows = _workerBatch.runElections(*bounds)
+    return rows, dict(resultsCacheTally)
+
+class CsvResults:
+    """Writes result rows to a CSV file: the run metadata as a # comment line,
+    then a header, then the rows."""
+    extension = ".csv"
+
+    def __init__(self, fileName, fieldNames, metadata):
+        self.file = open(fileName, "w")
+        print("# " + str(metadata), file=self.file)
+        self.writer = csv.DictWriter(self.file, fieldNames, restval = "NA")
+        self.writer.writeheader()
+
+    @classmethod
+    def reopen(cls, fileName, fieldNames, offset):
+        """Reopen a partly written file to append to it, first cutting off
+        anything past offset (as returned by tell) -- eg rows written after the
+        last checkpoint."""
+        self = cls.__new__(cls)
+        self.file = open(fileName, "r+")
+        self.file.seek(offset)
+        self.file.truncate()
+        self.writer = csv.DictWriter(self.file, fieldNames, restval = "NA")
+        return self
+
+    def writerows(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+class NpzResults:
+    """Writes result rows as typed columns to a compressed NumPy .npz file.
+
+    eid, emodel, method, chooser and the tallyNames are categorical: an int32
+    array of codes (-1 for missing) plus a "<name>_categories" array of strings.
+    ncand and nvot are int64; everything else is float64 (NaN for missing).
+    Non-numeric tally values (eg Schulze's scenario) go in a categorical
+    tallyText<n> column next to tallyVal<n>. The run metadata is stored as a
+    JSON string.
+
+        >>> import tempfile
+        >>> fileName = os.path.join(tempfile.mkdtemp(), "r.npz")
+        >>> out = NpzResults(fileName, ["vse", "method", "nvot", "tallyName0", "tallyVal0"], dict(seed=1))
+        >>> out.writerows([dict(vse=0.5, method="Irv", nvot=3, tallyName0="scenario", tallyVal0="cycle"),
+        ...                dict(vse=1.0, method="Mav", nvot=3, tallyName0="worked", tallyVal0=True)])
+        >>> out.close()
+        >>> columns, meta = loadNpz(fileName)
+        >>> columns["vse"].dtype, columns["nvot"].dtype, columns["method"].tolist(), meta
+        (dtype('float64'), dtype('int64'), ['Irv', 'Mav'], {'seed': 1})
+        >>> columns["tallyVal0"].tolist(), columns["tallyText0"].tolist()
+        ([nan, 1.0], ['cycle', ''])
+
+    Columns are written out in chunks of chunkRows rows (as "<name>.<chunk>"
+    arrays, which loadNpz joins up), so memory use doesn't grow with the run.
+    But the file can't be read until close() has finished it.
+
+        >>> names = ["eid", "method", "chooser", "vse", "tallyName0", "tallyVal0"]
+        >>> rows = [dict(eid="e%d" % (i // 2), method=method, chooser="hon", vse=i / 4,
+        ...              tallyName0="worked", tallyVal0=i)
+        ...         for i, method in enumerate(["Irv", "Mav", "Irv"])]
+        >>> out = NpzResults(fileName, names, dict())
+        >>> out.chunkRows = 2
+        >>> out.writerows(rows[:1]); out.writerows(rows[1:]); out.close()
+        >>> out.chunks
+        2
+        >>> columns, meta = loadNpz(fileName)
+        >>> [[columns[key][i].item() for key in names] for i in range(3)] == [
+        ...     [row[key] for key in names] for row in rows]
+        True
+    """
+    extension = ".npz"
+    categorical = {"eid", "emodel", "method", "chooser"}
+    integer = {"ncand", "nvot"}
+    chunkRows = 100000
+
+    def __init__(self, fileName, fieldNames, metadata):
+        self.fileName = fileName
+        self.zip = zipfile.ZipFile(fileName, "w", compression=zipfile.ZIP_DEFLATED)
+        self.writeArray("metadata", np.array(json.dumps(metadata, default=str)))
+        self.columns = dict()
+        for key in fieldNames:
+            if key in self.categorical or key.startswith("tallyName"):
+                self.columns[key] = CategoricalColumn()
+            elif key in self.integer:
+                self.columns[key] = array("q")
+            else:
+                self.columns[key] = array("d")
+                if key.startswith("tallyVal"):
+                    self.columns[key.replace("Val", "Text")] = CategoricalColumn()
+        self.buffered = 0
+        self.chunks = 0
+
+    def writeArray(self, name, values):
+        with self.zip.open(name + ".npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, values, allow_pickle=False)
+
+    def writerows(self, rows):
+        for row in rows:
+            for key, column in self.columns.items():
+                value = row.get(key)
+                if key.startswith("tallyText"):
+                    value = row.get(key.replace("Text", "Val"))
+                    column.append(None if isNumber(value) or value is None else value)
+                elif isinstance(column, CategoricalColumn):
+                    column.append(value)
+                elif key.startswith("tallyVal"):
+                    column.append(float(value) if isNumber(value) else float("nan"))
+                else:
+                    column.append(float("nan") if value is None else value)
+            self.buffered += 1
+            if self.buffered >= self.chunkRows:
+                self.flush()
+
+    def flush(self):
+        """Write out the rows so far as the next chunk of each column."""
+        for key, column in self.columns.items():
+            name = "{}.{}".format(key, self.chunks)
+            if isinstance(column, CategoricalColumn):
+                self.writeArray(name, np.array(column.codes, dtype=np.int32))
+                column.codes = array("i")
+            else:
+                self.writeArray(name, np.array(column))
+                self.columns[key] = array(column.typecode)
+        self.buffered = 0
+        self.chunks += 1
+
+    def close(self):
+        if self.buffered or not self.chunks:
+            self.flush()
+        for key, column in self.columns.items():
+            if isinstance(column, CategoricalColumn):
+                self.writeArray(key + "_categories", np.array(column.categories, dtype=str))
+        self.zip.close()
+
+def isNumber(value):
+    """Like isnum, but also true for NumPy scalars (including numpy bools)."""
+    return isinstance(value, (numbers.Number, np.bool_))
+
+class CategoricalColumn:
+    """int codes for a column of strings, plus the list of distinct strings."""
+    def __init__(self):
+        self.codes = array("i")
+        self.categories = []
+        self.index = dict()
+
+    def append(self, value):
+        if value is None:
+            self.codes.append(-1)
+            return
+        value = str(value)
+        try:
+            self.codes.append(self.index[value])
+        except KeyError:
+            self.index[value] = len(self.categories)
+            self.codes.append(len(self.categories))
+            self.categories.append(value)
+
+def loadNpz(fileName):
+    """Read a file written by NpzResults; returns (columns, metadata), with
+    categorical columns decoded to arrays of strings ("" for missing)."""
+    chunks = dict()
+    with np.load(fileName) as data:
+        metadata = json.loads(str(data["metadata"]))
+        for name in data.files:
+            if name == "metadata" or name.endswith("_categories"):
+                continue
+            key, _, chunk = name.rpartition(".")
+            chunks.setdefault(key, []).append((int(chunk), data[name]))
+        columns = dict()
+        for key, parts in chunks.items():
+            values = np.concatenate([part for _, part in sorted(parts, key=lambda p: p[0])])
+            if key + "_categories" in data.files:
+                categories = np.append(data[key + "_categories"], "")
+                values = categories[values] #code -1 picks the ""
+            columns[key] = values
+    return columns, metadata
+
+resultFormats = dict(csv=CsvResults, npz=NpzResults)
+
 class CsvBatch:
     @timeit
     @autoassign
     def __init__(self, model, methods, nvot, ncand, niter,
-            baseName = None, media=truth, seed=None, force=False):
+            baseName = None, media=truth, seed=None, force=False, workers=None,
+            stream=False, fileFormat="csv", checkpointEvery=None, resume=None):
         """A harness function which creates niter elections from model and finds three kinds
         of utility for all methods given.
 
@@ -42,9 +253,80 @@ class CsvBatch:
         >>> csvs = CsvBatch(PolyaModel(), [[Score(), baseRuns], [Mav(), medianRuns]], nvot=5, ncand=4, niter=3)
         >>> len(csvs.rows)
         54
+
+        With workers=N, elections are sharded across N processes. Each election
+        then gets its own RNG streams derived from the seed, so the rows are
+        identical whatever the number of workers:
+
+        >>> serial = CsvBatch(PolyaModel(), [[Score(), baseRuns]], nvot=5, ncand=4, niter=4, workers=1) # doctest: +ELLIPSIS
+        '__init__' ...
+        >>> pooled = CsvBatch(PolyaModel(), [[Score(), baseRuns]], nvot=5, ncand=4, niter=4, workers=2) # doctest: +ELLIPSIS
+        '__init__' ...
+        >>> serial.rows == pooled.rows
+        True
+
+        Each batch counts its own results cache hits and misses, workers' included:
+
+        >>> serial.resultsCacheTally == pooled.resultsCacheTally, serial.resultsCacheTally["miss"] > 0
+        (True, True)
+
+        With stream=True (which needs a baseName), rows are written to the file
+        as each election (or, with workers, each shard) finishes, instead of
+        being kept in self.rows; memory use then doesn't grow with niter.
+
+        fileFormat="npz" saves typed columns (see NpzResults) instead of CSV text.
+
+        checkpointEvery=k streams CSV rows as above and, at least every k
+        elections, records in <fileName>.ckpt how many elections are done, the
+        seed that (with the election number) determines their RNG streams, and
+        how far into the file their rows go. If the run dies, calling CsvBatch
+        again with the same arguments plus resume=<fileName> cuts the file back
+        to the last checkpoint and carries on from there, so the file ends up
+        exactly as an uninterrupted run would have left it. Both options use
+        per-election RNG streams (workers=1 if workers isn't given). The .ckpt
+        file is removed when the run completes.
+
+        >>> import tempfile
+        >>> baseName = os.path.join(tempfile.mkdtemp(), "r")
+        >>> args = (PolyaModel(), [[Score(), baseRuns]], 5, 4, 6)
+        >>> whole = CsvBatch(*args, baseName=baseName, seed=1, stream=True, workers=1) # doctest: +ELLIPSIS
+        '__init__' ...
+        >>> class Preempted(Exception): pass
+        >>> def dieAfter4(batch, start, stop, run=CsvBatch.runElections):
+        ...     if stop > 4: raise Preempted
+        ...     return run(batch, start, stop)
+        >>> CsvBatch.runElections, original = dieAfter4, CsvBatch.runElections
+        >>> try:
+        ...     CsvBatch(*args, baseName=baseName, seed=1, checkpointEvery=2)
+        ... except Preempted:
+        ...     pass
+        >>> CsvBatch.runElections = original
+        >>> fileName = baseName + "2.csv"
+        >>> with open(fileName + ".ckpt") as f: json.load(f)["done"]
+        4
+        >>> resumed = CsvBatch(*args, seed=1, resume=fileName) # doctest: +ELLIPSIS
+        '__init__' ...
+        >>> def body(name):
+        ...     with open(name) as f: return f.readlines()[1:] #skip the metadata line
+        >>> body(fileName) == body(whole.fileName), os.path.exists(fileName + ".ckpt")
+        (True, False)
+
+        A run that dies before its first checkpoint resumes from the start:
+
+        >>> CsvBatch.runElections = dieAfter4
+        >>> try:
+        ...     CsvBatch(*args, baseName=baseName, seed=1, checkpointEvery=10)
+        ... except Preempted:
+        ...     pass
+        >>> CsvBatch.runElections = original
+        >>> fileName = baseName + "3.csv"
+        >>> with open(fileName + ".ckpt") as f: json.load(f)["done"]
+        0
+        >>> resumed = CsvBatch(*args, seed=1, resume=fileName) # doctest: +ELLIPSIS
+        '__init__' ...
+        >>> body(fileName) == body(whole.fileName)
+        True
         """
-        rows = []
-        emodel = str(model)
         if (seed is None):
             seed = (baseName or '') + str(niter)
             self.seed = seed
@@ -57,46 +339,192 @@ class CsvBatch:
             self.repo_version = repo.head.commit.hexsha
         except:
             self.repo_version = 'unknown repo version'
-        for i in range(niter):
+        if checkpointEvery or resume:
+            assert fileFormat == "csv", "only CSV output can be resumed"
+            stream = True
+            if workers is None:
+                self.workers = 1
+        if stream:
+            done = 0
+            if resume:
+                out, done = self.resumeFile(resume)
+            else:
+                assert baseName, "streaming needs a baseName to write to"
+                out = self.openFile(baseName)
+                if checkpointEvery:
+                    self.saveCheckpoint(0, out.tell()) #just the header so far
+            lastCheckpoint = done
+            try:
+                for done, rows in self.rowBatches(done):
+                    out.writerows(rows)
+                    if checkpointEvery and done - lastCheckpoint >= checkpointEvery:
+                        self.saveCheckpoint(done, out.tell())
+                        lastCheckpoint = done
+            finally:
+                out.close()
+            if os.path.exists(self.fileName + ".ckpt"):
+                os.remove(self.fileName + ".ckpt")
+            self.rows = None
+            return
+        self.rows = [row for _, rows in self.rowBatches() for row in rows]
+        if baseName:
+            self.saveFile(baseName)
+
+    def saveCheckpoint(self, done, offset):
+        """Record that the first `done` elections' rows fill self.fileName up
+        to offset. Written to a temporary file and renamed, so a crash leaves
+        either the old checkpoint or the new one."""
+        checkpoint = dict(done=done, offset=offset, seed=str(self.seed),
+                          niter=self.niter, workers=self.workers)
+        with open(self.fileName + ".ckpt.tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(self.fileName + ".ckpt.tmp", self.fileName + ".ckpt")
+
+    def resumeFile(self, fileName):
+        """Reopen fileName at its last checkpoint; returns (out, done)."""
+        with open(fileName + ".ckpt") as f:
+            checkpoint = json.load(f)
+        assert (checkpoint["seed"], checkpoint["niter"], checkpoint["workers"]
+                ) == (str(self.seed), self.niter, self.workers), \
+                "resume with the same seed, niter and workers as the checkpointed run"
+        self.fileName = fileName
+        out = CsvResults.reopen(fileName, self.fieldNames(), checkpoint["offset"])
+        return out, checkpoint["done"]
+
+    def rowBatches(self, start=0):
+        """Yields (elections done, rows) pairs: an election's rows at a time,
+        or with workers, a shard's at a time, starting from election start
+        (which needs workers).
+
+        Once they are all done, self.resultsCacheTally holds the batch's
+        results cache hits and misses (see Method.chosenResults)."""
+        resultsCacheTally.clear()
+        if self.workers is not None:
+            yield from self.runShards(self.workers, start)
+            self.resultsCacheTally = SideTally()
+            self.resultsCacheTally.update(resultsCacheTally)
+            return
+        assert start == 0
+        emodel = str(self.model)
+        electorates = self.model.electorates(self.niter, self.nvot, self.ncand,
+                                             rng=defaultRng())
+        for i, electorate in enumerate(electorates):
             eid = uuid4()
-            electorate = model(nvot, ncand)
-            for method, chooserFuns in methods:
-                results = method.resultsTable(eid, emodel, ncand, electorate, chooserFuns, media=media)
+            rows = []
+            for method, chooserFuns in self.methods:
+                results = method.resultsTable(eid, emodel, self.ncand, electorate, chooserFuns,
+                                              media=self.media)
                 rows.extend(results)
             debug(i,results[1:3])
-        self.rows = rows
-        if baseName:
-            self.saveFile(baseName)
+            yield i + 1, rows
+        self.resultsCacheTally = SideTally()
+        self.resultsCacheTally.update(resultsCacheTally)
+
+    def runElections(self, start, stop):
+        """Rows for elections start..stop-1, each from its own RNG streams."""
+        rows = []
+        emodel = str(self.model)
+        for i in range(start, stop):
+            rng = electionRng(self.seed, i)
+            eid = UUID(int=random.getrandbits(128), version=4)
+            electorate = self.model(self.nvot, self.ncand, rng=rng)
+            for method, chooserFuns in self.methods:
+                results = method.resultsTable(eid, emodel, self.ncand, electorate, chooserFuns,
+                                              media=self.media)
+                rows.extend(results)
+            debug(i,results[1:3])
+        return rows
+
+    def runShards(self, workers, start=0):
+        """Yields (elections done, rows) for each shard of elections from
+        start on, in election order.
+
+        Workers are forked, so they inherit the model, methods and media (which
+        are often closures that can't be pickled); only shard bounds and rows
+        cross between processes, along with each shard's results cache tally,
+        which is added to this process's."""
+        global _workerBatch
+        shardSize = max(1, min(self.niter // (4 * workers), 100))
+        shards = [(first, min(first + shardSize, self.niter))
+                  for first in range(start, self.niter, shardSize)]
+        if workers == 1:
+            for shard in shards:
+                yield shard[1], self.runElections(*shard)
+            return
+        _workerBatch = self
+        with ProcessPoolExecutor(workers,
+                                 mp_context=multiprocessing.get_context("fork")) as pool:
+            for (_, stop), (rows, cacheTally) in zip(shards, pool.map(_runShard, shards)):
+                for key, count in cacheTally.items():
+                    resultsCacheTally[key] += count
+                yield stop, rows
+        _workerBatch = None
+
+    minTallySlots = 4
+
+    def fieldNames(self):
+        """The CSV header, fixed by the configuration rather than by the rows:
+        with as many tally columns as the methods' and choosers' tallies can
+        fill (see Method.tallySlots), but at least the minTallySlots pairs
+        that files have always had:
+            >>> batch = CsvBatch.__new__(CsvBatch)
+            >>> batch.methods = [[Score(), baseRuns]]
+            >>> batch.fieldNames()[-2:]
+            ['tallyName3', 'tallyVal3']
+
+        A chooser with more tallies than usual gets the columns it needs:
+            >>> import tempfile
+            >>> wide = ProbChooser([(.2, beHon), (.2, beStrat), (.2, OssChooser()),
+            ...                     (.2, OssChooser([beStrat, beHon])),
+            ...                     (.2, ProbChooser([(.5, beHon), (.5, beStrat)]))])
+            >>> batch = CsvBatch(PolyaModel(), [[Score(), [wide]]], nvot=25, ncand=4, niter=2,
+            ...                  baseName=os.path.join(tempfile.mkdtemp(), "w"), stream=True) # doctest: +ELLIPSIS
+            '__init__' ...
+            >>> batch.fieldNames()[:4], len(batch.fieldNames())
+            (['vse', 'method', 'chooser', 'eid'], 28)
+            >>> with open(batch.fileName) as f:
+            ...     rows = list(csv.DictReader(f.readlines()[1:]))
+            >>> max(sum(row[k] != "NA" for k in row if k.startswith("tallyName")) for row in rows) > 4
+            True
+        """
+        keys = ["vse","method","chooser", #important stuff first
+                "eid","emodel","ncand","nvot","best","rand","util"]
+        tallySlots = max([self.minTallySlots] +
+                         [method.tallySlots(chooserFuns) for method, chooserFuns in self.methods])
+        for n in range(tallySlots):
+            keys.extend(["tallyName"+str(n),"tallyVal"+str(n)])
+        return keys
+
+    def metadata(self):
+        return dict(media = self.media.__name__,
+                    version = self.repo_version,
+                    seed=self.seed,
+                    model=self.model,
+                    methods=self.methods,
+                    nvot=self.nvot,
+                    ncand=self.ncand,
+                    niter=self.niter)
+
+    def openFile(self, baseName, fileFormat=None):
+        """Open the first free baseName<i> file of the given format (by default,
+        self.fileFormat) for writing results."""
+        resultsFile = resultFormats[fileFormat or self.fileFormat]
+        i = 1
+        while os.path.isfile(baseName + str(i) + resultsFile.extension):
+            i += 1
+        self.fileName = baseName + str(i) + resultsFile.extension
+        return resultsFile(self.fileName, self.fieldNames(), self.metadata())
 
-    def saveFile(self, baseName="SimResults"):
+    def saveFile(self, baseName="SimResults", fileFormat=None):
         """print the result of doVse in an accessible format.
         for instance:
 
         csvs.saveFile()
+        csvs.saveFile(fileFormat="npz")
         """
-        i = 1
-        while os.path.isfile(baseName + str(i) + ".csv"):
-            i += 1
-        keys = ["vse","method","chooser"] #important stuff first
-        keys.extend(list(self.rows[0].keys())) #any other stuff I missed; dedup later
-        for n in range(4):
-            keys.extend(["tallyName"+str(n),"tallyVal"+str(n)])
-        keys = uniquify(keys)
-        myFile = open(baseName + str(i) + ".csv", "w")
-        print("# " + str(dict(media = self.media.__name__,
-                             version = self.repo_version,
-                             seed=self.seed,
-                             model=self.model,
-                             methods=self.methods,
-                             nvot=self.nvot,
-                             ncand=self.ncand,
-                             niter=self.niter)),
-            file=myFile)
-        dw = csv.DictWriter(myFile, keys, restval = "NA")
-        dw.writeheader()
-        for r in self.rows:
-            dw.writerow(r)
-        myFile.close()
+        out = self.openFile(baseName, fileFormat)
+        out.writerows(self.rows)
+        out.close()
 
 
 